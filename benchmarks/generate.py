@@ -0,0 +1,104 @@
+"""Generate a synthetic evox repository.
+
+Usage:
+  generate.py [--packages=<n>] [--files=<n>] [--fanout=<n>] [--file-size=<bytes>] [--version=<version>] [--seed=<n>] <repo>
+  generate.py (-h | --help)
+
+Options:
+  --packages=<n>        Number of packages [default: 100]
+  --files=<n>           Number of files in each package [default: 50]
+  --fanout=<n>          Maximum number of dependencies of each package [default: 3]
+  --file-size=<bytes>   Size of each file [default: 1024]
+  --version=<version>   Version of the packages [default: 1.0]
+  --seed=<n>            Seed of the random generator, the same seed gives the same repository [default: 0]
+  -h --help             Show this screen.
+
+"""
+
+# The packages are named bench-<n>, each one has files under usr/share/bench-<n>/,
+# and can only depend on packages with a lower number, so there is no dependency cycle.
+# The INDEX gives the dependencies, the checksum and the description of each package.
+
+import io
+import os
+import random
+import hashlib
+import tarfile
+import zstandard
+from docopt import docopt
+
+def _add_file(tar: tarfile.TarFile, name: str, data: bytes, mode: int = 0o644):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = mode
+    tar.addfile(info, io.BytesIO(data))
+
+def _add_dir(tar: tarfile.TarFile, name: str):
+    info = tarfile.TarInfo(name)
+    info.type = tarfile.DIRTYPE
+    info.mode = 0o755
+    tar.addfile(info)
+
+def make_package(repo: str, name: str, version: str, depends: list, files: int, file_size: int):
+    # Write the package <repo>/<name>-<version>.evx
+    # Returns its SHA-256 checksum
+    tree = ["usr", "usr/share", "usr/share/" + name]
+    tree += ["usr/share/" + name + "/file-" + str(n) for n in range(files)]
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        _add_dir(tar, name)
+        _add_dir(tar, name + "/metadata")
+        _add_file(tar, name + "/metadata/PKGINFO", ("name = " + name + "\nversion = " + version + "\ndescription = Synthetic package " + name +
+                                                     "\nsource = https://example.org/" + name + "\npkgrel = 1\n").encode())
+        if len(depends) > 0:
+            _add_file(tar, name + "/metadata/PKGDEPS", ("\n".join(depends) + "\n").encode())
+        _add_file(tar, name + "/metadata/PKGTREE", ("\n".join(tree) + "\n").encode())
+
+        _add_dir(tar, name + "/data")
+        for path in tree[:3]:
+            _add_dir(tar, name + "/data/" + path)
+        # The content depends on the version, so an upgrade really changes the files
+        content = (name + version).encode()
+        content = (content * (file_size // len(content) + 1))[:file_size]
+        for path in tree[3:]:
+            _add_file(tar, name + "/data/" + path, content)
+
+        _add_dir(tar, name + "/scripts")
+
+    data = zstandard.ZstdCompressor().compress(buffer.getvalue())
+    with open(os.path.join(repo, name + "-" + version + ".evx"), "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+def generate(repo: str, packages: int = 100, files: int = 50, fanout: int = 3, file_size: int = 1024, version: str = "1.0", seed: int = 0):
+    # Generate a repository in the directory repo, replacing the previous packages
+    # Returns a dictionary with the dependencies of each package
+    os.makedirs(repo, exist_ok=True)
+    for name in os.listdir(repo):
+        if name.endswith(".evx"):
+            os.remove(os.path.join(repo, name))
+
+    # The dependencies only depend on the seed, not on the version
+    generator = random.Random(seed)
+    depends = {}
+    index = []
+    for n in range(packages):
+        name = "bench-" + str(n)
+        depends[name] = ["bench-" + str(dep) for dep in sorted(generator.sample(range(n), min(n, generator.randint(0, fanout))))]
+        sha256 = make_package(repo, name, version, depends[name], files, file_size)
+
+        line = name + " " + version + " 1 sha256=" + sha256 + " description=Synthetic%20package%20" + name
+        if len(depends[name]) > 0:
+            line += " depends=" + ",".join(depends[name])
+        index.append(line)
+
+    with open(os.path.join(repo, "INDEX"), "w") as f:
+        f.write("\n".join(index) + "\n")
+
+    return depends
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    generate(arguments['<repo>'], int(arguments['--packages']), int(arguments['--files']), int(arguments['--fanout']),
+             int(arguments['--file-size']), arguments['--version'], int(arguments['--seed']))
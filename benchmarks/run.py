@@ -0,0 +1,155 @@
+"""Benchmark evox on a synthetic repository.
+
+Usage:
+  run.py [--packages=<n>] [--files=<n>] [--fanout=<n>] [--file-size=<bytes>] [--jobs=<n>] [--repeat=<n>] [--http] [--keep] [--output=<file>]
+  run.py (-h | --help)
+
+Options:
+  --packages=<n>        Number of packages [default: 100]
+  --files=<n>           Number of files in each package [default: 50]
+  --fanout=<n>          Maximum number of dependencies of each package [default: 3]
+  --file-size=<bytes>   Size of each file [default: 1024]
+  --jobs=<n>            Number of packages unpacked at the same time by get and upgrade [default: 1]
+  --repeat=<n>          Number of times the whole scenario is run [default: 1]
+  --http                Serve the repository with a local HTTP server instead of reading it from its directory
+  --keep                Keep the working directory (the repository and the root of the last run)
+  --output=<file>       Write the JSON results to a file instead of the standard output
+  -h --help             Show this screen.
+
+"""
+
+# Each run creates a new root (ROOT=<workdir>/root) and runs the real evox (evox/main.py) on it:
+# sync, search, get (all the packages), tree, upgrade (after a new version of every package is generated),
+# remove (all the packages) and a last sync.
+# The results are printed as JSON, with the time of each step of each run, so they can be tracked over time.
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+import http.server
+from functools import partial
+from docopt import docopt
+
+import generate
+
+EVOX = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "evox", "main.py")
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    # We don't log the requests, the results are printed on the standard output
+    def log_message(self, *args):
+        pass
+
+def serve(directory: str):
+    # Serve a directory with an HTTP server in a thread
+    # Returns the server and its URL
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_address[1])
+
+def make_root(root: str, url: str):
+    # Create the structure of evox in a new root, like `evox init` does
+    os.makedirs(os.path.join(root, "etc"))
+    os.makedirs(os.path.join(root, "var/evox/packages"))
+    os.makedirs(os.path.join(root, "var/evox/repos/bench"))
+    with open(os.path.join(root, "etc/evox.conf"), "w") as f:
+        f.write("REPO bench " + url + "\n")
+    open(os.path.join(root, "var/evox/packages/DB"), "w").close()
+
+def evox(root: str, args: list):
+    # Run evox in a root
+    # Returns the time it took, in seconds
+    env = dict(os.environ, ROOT=root)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, EVOX] + args, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=root)
+    seconds = time.perf_counter() - start
+
+    if result.returncode != 0:
+        sys.stderr.write(result.stdout.decode(errors="replace"))
+        raise Exception("evox " + " ".join(args) + " failed with code " + str(result.returncode))
+    return seconds
+
+def run(workdir: str, arguments: dict):
+    # Run the whole scenario once
+    # Returns a list of tuples (step, seconds)
+    repo = os.path.join(workdir, "repo")
+    root = os.path.join(workdir, "root")
+    packages = int(arguments['--packages'])
+    jobs = arguments['--jobs']
+    options = (packages, int(arguments['--files']), int(arguments['--fanout']), int(arguments['--file-size']))
+
+    names = list(generate.generate(repo, *options, version="1.0"))
+
+    server = None
+    url = repo
+    if arguments['--http']:
+        server, url = serve(repo)
+
+    try:
+        shutil.rmtree(root, ignore_errors=True)
+        make_root(root, url)
+        steps = []
+        steps.append(("sync", evox(root, ["sync"])))
+        steps.append(("search", evox(root, ["search", "bench-1"])))
+        steps.append(("search --fuzzy", evox(root, ["search", "--fuzzy", "bch9"])))
+        steps.append(("get", evox(root, ["get", "-y", "--jobs=" + jobs] + names)))
+        steps.append(("tree", evox(root, ["tree", names[-1]])))
+        steps.append(("tree --reverse", evox(root, ["tree", "--reverse", names[0]])))
+
+        generate.generate(repo, *options, version="2.0")
+        steps.append(("sync (new versions)", evox(root, ["sync"])))
+        steps.append(("upgrade", evox(root, ["upgrade", "--jobs=" + jobs])))
+        # The packages are removed from the last one, so each one is removed after the packages depending on it
+        steps.append(("remove", evox(root, ["remove"] + names[::-1])))
+        steps.append(("sync (no change)", evox(root, ["sync"])))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    return steps
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+
+    workdir = tempfile.mkdtemp(prefix="evox-bench-")
+    runs = []
+    try:
+        for n in range(int(arguments['--repeat'])):
+            runs.append(run(workdir, arguments))
+    finally:
+        if not arguments['--keep']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # For each step, the time of each run and the median
+    results = {}
+    for steps in runs:
+        for step, seconds in steps:
+            results.setdefault(step, []).append(round(seconds, 4))
+
+    report = {
+        "date": time.strftime("%Y-%m-%d_%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {
+            "packages": int(arguments['--packages']),
+            "files": int(arguments['--files']),
+            "fanout": int(arguments['--fanout']),
+            "file_size": int(arguments['--file-size']),
+            "jobs": int(arguments['--jobs']),
+            "http": arguments['--http']
+        },
+        "results": [{"step": step, "median": round(statistics.median(times), 4), "runs": times} for step, times in results.items()]
+    }
+
+    if arguments['--output'] is not None:
+        with open(arguments['--output'], "w") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
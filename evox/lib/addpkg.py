@@ -3,6 +3,7 @@
 # So, we can just call it with the path to the file.
 
 import os
+import errno
 import shutil
 import time
 import tempfile
@@ -10,85 +11,222 @@ import tarfile
 import zstandard
 
 import lib.db as db
+import lib.pkgindex as pkgindex
+import lib.profile as profile
+import lib.readevx as readevx
+import lib.transaction as transaction
+import lib.triggers as triggers
 from lib.root import *
 
-def copy_dir(src: str, dest: str):
-    # Get all files and subfiles in the directory
-    files = os.listdir(src)
-    links = []
-
-    # For each file, we copy it to the destination
-    for file in files:
-        # If the file is a link, we add it to the links list
-        if os.path.islink(os.path.join(src, file)):
-            links.append(file)
-        elif os.path.isdir(os.path.join(src, file)):
-            # If it's a directory, we copy it recursively
-            copy_dir(os.path.join(src, file), os.path.join(dest, file))
+def _move(src: str, target: str):
+    # Move a file or a link to target, replacing what is there
+    # A rename keeps the file as it has been extracted (content, ownership, mode and time), and it's atomic:
+    # a running program sees either the old file or the new one
+    try:
+        os.replace(src, target)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # The staging directory isn't on the same filesystem as target, so we copy the file
+        # next to target and rename it from there
+        tmp = target + ".evox-tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), tmp)
         else:
-            # If it's a file, we just move it
-            os.makedirs(os.path.join(dest, os.path.dirname(file)), exist_ok=True)
-            # If the file exists (in case of upgrade), we remove it
-            if os.path.exists(os.path.join(dest, file)):
-                os.remove(os.path.join(dest, file))
-            
-            # Get the file owners
-            # We can use the os.stat function
-            stat = os.stat(os.path.join(src, file))
-            shutil.move(os.path.join(src, file), os.path.join(dest, file))
-            # We set the file owners
-            # We can use the os.chown function
-            os.chown(os.path.join(dest, file), stat.st_uid, stat.st_gid)
-            # We must also set the mode 
-            # We can use the os.chmod function
-            os.chmod(os.path.join(dest, file), stat.st_mode)
-
-    # For each link, we create it
-    for link in links:
-        # We get the link target
-        # We can use the os.readlink function
-        target = os.readlink(os.path.join(src, link))
-        # We create the link
-        # We can use the os.symlink function
-        # But first, just check if the link already exists
-        if not os.path.exists(os.path.join(dest, link)):
-            os.makedirs(os.path.join(dest, os.path.dirname(link)), exist_ok=True)
-            try:
-                os.symlink(target, os.path.join(dest, link))
-            except:
-                pass
-
-    if len(files) == 0:
-        # If the directory is empty, we create an empty directory at the destination
-        os.makedirs(dest, exist_ok=True)
+            shutil.copy2(src, tmp)
+            stat = os.lstat(src)
+            if os.geteuid() == 0:
+                os.chown(tmp, stat.st_uid, stat.st_gid)
+        os.replace(tmp, target)
+        os.remove(src)
 
-def addpkg(path: str, package: str, pkginfo: dict):
-    tempdir = tempfile.mkdtemp(dir=root + '/tmp')
-    os.chdir(tempdir)
+def find_obstacles(src: str, dest: str):
+    # Returns the list of the paths of dest that place can't replace: the directories of src
+    # that are something else than a directory (or a link to a directory) in dest, and the
+    # files or links of src that are a directory in dest
+    # Nothing is moved, so it's checked before the commit of a package begins
+    obstacles = []
+    dirs = [(src, dest)]
+    while len(dirs) > 0:
+        src_dir, dest_dir = dirs.pop()
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dest_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.isdir(target):
+                        dirs.append((entry.path, target))
+                    elif os.path.lexists(target):
+                        obstacles.append(target)
+                elif not entry.is_symlink() and os.path.isdir(target) and not os.path.islink(target):
+                    obstacles.append(target)
+    return obstacles
+
+def place(src: str, dest: str):
+    # Move the content of the directory src (a staging directory) to dest
+    # The directories that don't exist in dest yet are moved at once, with all their content,
+    # the other ones are walked, with the file types given by os.scandir (no stat for each file)
+    dirs = [(src, dest)]
+    while len(dirs) > 0:
+        src_dir, dest_dir = dirs.pop()
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                target = os.path.join(dest_dir, entry.name)
+
+                if entry.is_dir(follow_symlinks=False):
+                    # If target is a link to a directory (like /lib in a merged /usr), we follow it
+                    if os.path.lexists(target) and not os.path.isdir(target):
+                        raise NotADirectoryError("Can't install the directory " + target + ", there is already a file with this name")
+                    if not os.path.lexists(target):
+                        try:
+                            os.rename(entry.path, target)
+                            profile.count("renames")
+                            continue
+                        except OSError as e:
+                            if e.errno != errno.EXDEV:
+                                raise
+                            # We can't move a directory to another filesystem, we create it and move its content
+                            os.mkdir(target)
+                            shutil.copystat(entry.path, target)
+                            if os.geteuid() == 0:
+                                stat = os.lstat(entry.path)
+                                os.chown(target, stat.st_uid, stat.st_gid)
+                    dirs.append((entry.path, target))
+
+                elif entry.is_symlink():
+                    # We don't replace an existing file or directory by a link,
+                    # but we update the links of the previous version of the package
+                    if os.path.islink(target) or not os.path.lexists(target):
+                        _move(entry.path, target)
+                        profile.count("renames")
+
+                else:
+                    if os.path.isdir(target) and not os.path.islink(target):
+                        raise IsADirectoryError("Can't install the file " + target + ", there is already a directory with this name")
+                    _move(entry.path, target)
+                    profile.count("renames")
+
+def set_attributes(target: str, member: tarfile.TarInfo):
+    # Give a file or a directory the ownership, the mode and the time of its tar header
+    # We can only give it to another user if we are root
+    if os.geteuid() == 0:
+        os.chown(target, member.uid, member.gid)
+    os.chmod(target, member.mode)
+    os.utime(target, (member.mtime, member.mtime))
+
+def extract_member(tar: tarfile.TarFile, member: tarfile.TarInfo, dest: str, path: str, created: set = None, directories: list = None):
+    # Extract a member of a streamed archive to dest/path
+    # The ownership and the mode are taken from the tar header
+    # created is the set of the directories that already exist, so we only create each directory once
+    # The directories are only created: their header is added to directories, to be applied once all their
+    # content has been extracted (a directory can be read-only, and each file written in it changes its time)
+    target = os.path.join(dest, path)
+    if created is None:
+        created = set()
+
+    if member.isdir():
+        if target not in created:
+            os.makedirs(target, exist_ok=True)
+            created.add(target)
+        if directories is not None:
+            directories.append((target, member))
+        return
+
+    if os.path.dirname(target) not in created:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        created.add(os.path.dirname(target))
+
+    if member.issym():
+        # We don't replace an existing file or directory by a link (like /lib in a merged /usr),
+        # but we update the links of the previous version of the package
+        if os.path.islink(target):
+            os.remove(target)
+        elif os.path.exists(target):
+            return
+        try:
+            os.symlink(member.linkname, target)
+        except:
+            pass
+        return
+
+    # If the file exists (in case of upgrade), we remove it
+    # so that a running program keeps its old file instead of seeing it rewritten
+    if os.path.lexists(target):
+        os.remove(target)
+
+    if member.islnk():
+        # A hard link points to a file we have already extracted from the same archive
+        os.link(os.path.join(dest, member.linkname.split("/", 2)[2]), target)
+        return
+
+    with tar.extractfile(member) as source, open(target, "wb") as out:
+        shutil.copyfileobj(source, out, 1024 * 1024)
+    profile.count("files written")
+    profile.count("bytes written", member.size)
+
+    set_attributes(target, member)
+
+def extract(path: str, package: str, destinations: dict):
+    # Extract a package to the given destinations
+    # destinations gives the directory where the content of data/, metadata/ and scripts/ goes
 
     # The package is a tar zst archive
     # We must use zstandard to decompress it
-    # We use a decompressor
+    # We read the archive as a stream, straight from the decompressor, and each member
+    # is written directly to its destination: nothing is written to a temporary directory
+    created = set()
+    directories = []
+    for section in destinations:
+        os.makedirs(destinations[section], exist_ok=True)
+        created.add(destinations[section])
+
     with open(path, "rb") as f:
         dctx = zstandard.ZstdDecompressor()
         reader = dctx.stream_reader(f)
-        with open(package + ".tar", "wb") as out:
-            shutil.copyfileobj(reader, out)
-        
-    # We can now extract the archive
-    with tarfile.open(package + ".tar") as tar:
-        tar.extractall()
-    # We remove the archive
-    os.remove(package + ".tar")
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in readevx.iter_members(tar):
+                # The members are named <package>/<section>/<path>
+                parts = member.name.split("/", 2)
+                if parts[0] != package or len(parts) < 3 or parts[1] not in destinations or parts[2] == "":
+                    continue
+
+                extract_member(tar, member, destinations[parts[1]], parts[2], created, directories)
+
+    # The deepest directories first, so that setting the time of a directory doesn't change the one of its parent
+    for target, member in sorted(directories, key=lambda directory: -directory[0].count("/")):
+        set_attributes(target, member)
 
-    # We copy the content of data/ to the root
-    copy_dir(os.path.join(tempdir, package, "data"), root)
+def stagepkg(path: str, package: str):
+    # Extract a package to a staging directory (/var/evox/staging/<package>-XXXX),
+    # from where commitpkg moves it to the root
+    # Staging doesn't touch the root, so several packages can be staged at the same time
+    # Returns the staging directory
+    os.makedirs(os.path.join(root, "var/evox/staging"), exist_ok=True)
+    stagedir = tempfile.mkdtemp(prefix=package + "-", dir=os.path.join(root, "var/evox/staging"))
 
-    # We copy the content of metadata/ to the package directory
-    copy_dir(os.path.join(tempdir, package, "metadata"), os.path.join(root, "var/evox/packages/", package))
+    with profile.span("stage", package):
+        extract(path, package, {
+            "data": os.path.join(stagedir, "data"),
+            "metadata": os.path.join(stagedir, "metadata"),
+            "scripts": os.path.join(stagedir, "scripts")
+        })
 
-    # And we copy the content of scripts/ to the package directory
-    copy_dir(os.path.join(tempdir, package, "scripts"), os.path.join(root, "var/evox/packages/", package, "scripts"))
+    return stagedir
+
+def commitpkg(stagedir: str, package: str, pkginfo: dict):
+    # Install a package staged by stagepkg
+    # The commit is journaled, so it can be finished if evox is killed in the middle of it
+    # Returns the tuple (added, replaced, removed) of transaction.commit
+    return transaction.commit(stagedir, package, pkginfo['version'])
+
+def addpkg(path: str, package: str, pkginfo: dict):
+    # We stage the package before installing it, so that the installed files
+    # are only replaced once the whole package has been extracted
+    return commitpkg(stagepkg(path, package), package, pkginfo)
+
+def register(package: str, pkginfo: dict):
+    # Register an installed package and queue what needs to be run after its installation
 
     # We must add the package to the DB
     # But first, we need to get the current time (formatted like this: 2020-01-01_00:00:00)
@@ -96,16 +234,12 @@ def addpkg(path: str, package: str, pkginfo: dict):
     date = time.strftime("%Y-%m-%d_%H:%M:%S")
     db.register_local(package, pkginfo['version'], date)
 
-    shutil.rmtree(tempdir)
-    os.chdir(root)
-    
-    # If ldconfig is installed, we run it
-    # But we only run it when the root is / (not when we are in a chroot)
-    if root == "/" and os.path.exists("/sbin/ldconfig"):
-        os.system("/sbin/ldconfig")
-    
-    # if the package has a post-install script, we execute it
-    # But only when the root is / (not when we are in a chroot)
-    if os.path.exists(os.path.join(root, "var/evox/packages/", package, "scripts", "PKGPOST")) and root == "/":
-        # But first, chdir to the root
-        os.system("bash " + os.path.join(root, "var/evox/packages/", package, "scripts", "PKGPOST"))
+    # We import the metadata of the package into the metadata store: its info, its dependencies
+    # (the reverse dependency index) and its files (the file ownership index)
+    info = db.read_local_package_info(package)
+    tree = db.read_local_package_pkgtree(package)
+    pkgindex.add_package(package, info, db.read_local_package_pkgdeps(package), tree)
+
+    # ldconfig, the other triggers and the post-install script aren't run for each package,
+    # they are queued and run once, at the end of the transaction (see triggers.run)
+    triggers.queue(package, info, tree)
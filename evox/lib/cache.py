@@ -0,0 +1,165 @@
+# cache module keeps the downloaded packages, so that installing the same package again
+# (reinstall, rollback, or another root) doesn't download it again
+#
+# The cache directory is set by the CACHE_DIR option of the config file (/var/cache/evox in the root
+# by default). Pointing CACHE_DIR of several roots to the same directory shares the cache between them.
+# It has the following structure:
+# - objects/<sha256>: the packages, named by the SHA-256 checksum of their content
+# - refs/<name>-<version>-<pkgrel>: a link to the object of a package
+#
+# The size of the cache is limited by the CACHE_SIZE option (in MiB, 1024 by default, 0 for no limit).
+# When it's full, the least recently used packages are removed first.
+
+import os
+import shutil
+import hashlib
+
+import lib.config as config
+
+from lib.root import *
+
+def get_cache_dir():
+    # Returns the cache directory
+    return config.get_option("CACHE_DIR", os.path.join(root, "var/cache/evox"))
+
+def get_cache_size():
+    # Returns the maximum size of the cache, in bytes (0 for no limit)
+    return int(config.get_option("CACHE_SIZE", 1024)) * 1024 * 1024
+
+def hash_file(path: str):
+    # Returns the SHA-256 checksum of a file
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buffer = f.read(1024 * 1024)
+            if not buffer:
+                break
+            sha256.update(buffer)
+    return sha256.hexdigest()
+
+def _ref(name: str, version: str, pkgrel):
+    return os.path.join(get_cache_dir(), "refs", name + "-" + version + "-" + str(pkgrel))
+
+def _copy(src: str, dest: str):
+    # Hard link a file if we can (same filesystem), copy it if we can't
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+def lookup(name: str, version: str, pkgrel, sha256: str = None):
+    # Returns the path of a package in the cache, or None if it isn't in the cache
+    # When the checksum of the package is known (from the catalog), we look its object up directly:
+    # a package republished with the same version and pkgrel has another checksum, so the old one isn't used
+    # Else we follow the ref, and check that the object still has the checksum it's named after
+    if sha256 is not None:
+        path = os.path.join(get_cache_dir(), "objects", sha256)
+        if not os.path.isfile(path):
+            return None
+    else:
+        ref = _ref(name, version, pkgrel)
+        if not os.path.exists(ref):
+            return None
+        path = os.path.realpath(ref)
+        if hash_file(path) != os.path.basename(path):
+            # The object is corrupted, we forget it
+            os.remove(path)
+            os.remove(ref)
+            return None
+
+    # We mark the package as recently used
+    os.utime(path)
+    return path
+
+def get(name: str, version: str, pkgrel, dest: str, sha256: str = None):
+    # Copy a package from the cache to dest
+    # If sha256 is given, only the package with this checksum is taken
+    # Returns True if the package was in the cache, False if it wasn't
+    path = lookup(name, version, pkgrel, sha256)
+    if path is None:
+        return False
+    _copy(path, dest)
+    return True
+
+def store(path: str, name: str, version: str, pkgrel, sha256: str = None):
+    # Add a downloaded package to the cache
+    # If the checksum of the package has already been checked, it's not computed again
+    # Returns its checksum
+    if sha256 is None:
+        sha256 = hash_file(path)
+    obj = os.path.join(get_cache_dir(), "objects", sha256)
+
+    os.makedirs(os.path.dirname(obj), exist_ok=True)
+    os.makedirs(os.path.dirname(_ref(name, version, pkgrel)), exist_ok=True)
+
+    if not os.path.exists(obj):
+        # We copy the package under a temporary name first, so the object is never incomplete
+        _copy(path, obj + ".tmp")
+        os.replace(obj + ".tmp", obj)
+    else:
+        os.utime(obj)
+
+    ref = _ref(name, version, pkgrel)
+    if os.path.lexists(ref):
+        os.remove(ref)
+    os.symlink(os.path.join("..", "objects", sha256), ref)
+
+    return sha256
+
+def get_objects():
+    # Returns a list of tuples (path, size, last use) of the packages in the cache
+    objects = []
+    objects_dir = os.path.join(get_cache_dir(), "objects")
+    if os.path.isdir(objects_dir):
+        with os.scandir(objects_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    objects.append((entry.path, stat.st_size, stat.st_mtime))
+    return objects
+
+def remove_dangling_refs():
+    # Remove the refs whose package has been removed from the cache
+    refs_dir = os.path.join(get_cache_dir(), "refs")
+    if os.path.isdir(refs_dir):
+        with os.scandir(refs_dir) as entries:
+            for entry in entries:
+                if not os.path.exists(entry.path):
+                    os.remove(entry.path)
+
+def evict(max_size: int = None):
+    # Remove the least recently used packages until the cache is smaller than max_size
+    if max_size is None:
+        max_size = get_cache_size()
+    if max_size <= 0:
+        return
+
+    objects = get_objects()
+    size = sum(obj[1] for obj in objects)
+    if size <= max_size:
+        return
+
+    # The least recently used packages first
+    objects.sort(key=lambda obj: obj[2])
+    for path, obj_size, last_use in objects:
+        if size <= max_size:
+            break
+        os.remove(path)
+        size -= obj_size
+
+    remove_dangling_refs()
+
+def clean():
+    # Remove all the packages from the cache
+    for directory in ("objects", "refs"):
+        if os.path.isdir(os.path.join(get_cache_dir(), directory)):
+            shutil.rmtree(os.path.join(get_cache_dir(), directory))
+
+def stats():
+    # Returns a tuple (number of packages, number of refs, size in bytes) of the cache
+    objects = get_objects()
+    refs_dir = os.path.join(get_cache_dir(), "refs")
+    refs = len(os.listdir(refs_dir)) if os.path.isdir(refs_dir) else 0
+    return len(objects), refs, sum(obj[1] for obj in objects)
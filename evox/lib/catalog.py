@@ -0,0 +1,173 @@
+# catalog module compiles the INDEX files of all the repositories into a single
+# SQLite database, so that the remote packages can be looked up without reading
+# every INDEX file again.
+#
+# The catalog (/var/evox/CATALOG) is built by `evox sync` and has one row per package:
+# <package name> <repo> <version> <pkgrel> <priority> <depends> <sha256> <description>
+# The priority is the position of the repository in the config file. When a package
+# is in several repositories, only the one with the lowest priority is kept.
+#
+# The trigrams and words tables are the search index (see lib/search.py):
+# - trigrams maps each trigram (3 consecutive characters) of the names, in lower case, to the packages:
+#   <trigram> <package name>
+# - words maps each word of the descriptions, in lower case, to the packages, sorted so that
+#   the words starting with a prefix are found with a range lookup:
+#   <word> <package name>
+
+import os
+import re
+import sqlite3
+from urllib.parse import quote, unquote
+
+import lib.config as config
+import lib.db as db
+
+from lib.root import *
+
+CATALOG = root + "/var/evox/CATALOG"
+# The version of the catalog format, bumped each time the format changes
+# so that a catalog built by an older evox gets rebuilt
+CATALOG_VERSION = 4
+
+# The connection is opened only once per process
+_connection = None
+
+def read_index(repo: str):
+    # Read the INDEX file of a repository (/var/evox/repos/<repo>/INDEX)
+    # The INDEX file has the following format:
+    # <package name> <version> <pkgrel> [<field>=<value> ...]
+    # The optional fields are:
+    # - depends: the dependencies of the package, separated by commas
+    # - sha256: the SHA-256 checksum of the package file
+    # - description: the description of the package
+    # The values are URL-encoded (a space is written %20)
+    # Returns a list of tuples (name, version, pkgrel, fields)
+    packages = []
+    index = root + "/var/evox/repos/" + repo + "/INDEX"
+    if os.path.isfile(index):
+        with open(index, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue
+                pkgrel = int(fields[2]) if len(fields) > 2 else None
+                extra = {}
+                for field in fields[3:]:
+                    key, _, value = field.partition("=")
+                    extra[key] = unquote(value)
+                packages.append((fields[0], fields[1], pkgrel, extra))
+    return packages
+
+def build(repos: list):
+    # Compile the INDEX files of the given repositories, in priority order
+    # We build the new catalog in a temporary file and rename it over the old one,
+    # so a reader never sees a half-built catalog
+    close()
+
+    tmp = CATALOG + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    connection = sqlite3.connect(tmp)
+    # The temporary file is thrown away if we are interrupted, so we don't need a journal
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    _fill(connection, repos)
+    connection.close()
+
+    os.replace(tmp, CATALOG)
+
+def _fill(connection, repos: list):
+    # Create the tables of the catalog and fill them with the INDEX files of the repositories
+    connection.execute("CREATE TABLE packages (name TEXT PRIMARY KEY, repo TEXT, version TEXT, pkgrel INTEGER, priority INTEGER, depends TEXT, sha256 TEXT, description TEXT)")
+    connection.execute("CREATE TABLE trigrams (trigram TEXT, name TEXT, PRIMARY KEY (trigram, name)) WITHOUT ROWID")
+    connection.execute("CREATE TABLE words (word TEXT, name TEXT, PRIMARY KEY (word, name)) WITHOUT ROWID")
+    for priority, repo in enumerate(repos):
+        # When the INDEX doesn't give the dependencies, the checksum or the description of a package, they are NULL
+        rows = [(name, repo, version, pkgrel, priority, fields.get("depends"), fields.get("sha256"), fields.get("description")) for name, version, pkgrel, fields in read_index(repo)]
+        # If the package is already in the catalog, it comes from a repository with a higher priority
+        connection.executemany("INSERT OR IGNORE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    # We index the packages that have been kept
+    packages = connection.execute("SELECT name, description FROM packages").fetchall()
+    connection.executemany("INSERT INTO trigrams VALUES (?, ?)", [(trigram, name) for name, description in packages for trigram in trigrams(name)])
+    connection.executemany("INSERT INTO words VALUES (?, ?)", [(word, name) for name, description in packages for word in words(description or "")])
+    connection.execute("PRAGMA user_version = " + str(CATALOG_VERSION))
+    connection.commit()
+
+def trigrams(text: str):
+    # Returns the set of the trigrams of a text, in lower case
+    text = text.lower()
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+def words(text: str):
+    # Returns the set of the words of a text, in lower case
+    return set(re.findall(r"[a-z0-9]+", text.lower()))
+
+def _open_read_only():
+    # Returns a read-only connection to the catalog, or None if it doesn't exist or has an older format
+    if not os.path.isfile(CATALOG):
+        return None
+    try:
+        connection = sqlite3.connect("file:" + quote(CATALOG) + "?mode=ro", uri=True)
+        if connection.execute("PRAGMA user_version").fetchone()[0] == CATALOG_VERSION:
+            return connection
+        connection.close()
+    except sqlite3.Error:
+        pass
+    return None
+
+def is_current():
+    # Check if the catalog exists and has the current format
+    connection = _open_read_only()
+    if connection is None:
+        return False
+    connection.close()
+    return True
+
+def open_catalog():
+    # Returns the connection to the catalog, opened read-only
+    # If the catalog doesn't exist yet or has an older format (the repos were synced by an older evox),
+    # we build it when we hold the lock of the DB (see db.begin). Otherwise (search, or a normal user),
+    # we compile the INDEX files in memory, without writing anything
+    global _connection
+    if _connection is None:
+        _connection = _open_read_only()
+        if _connection is None and db._transaction_depth > 0:
+            build(list(config.get_config()))
+            _connection = _open_read_only()
+        if _connection is None:
+            _connection = sqlite3.connect(":memory:")
+            _fill(_connection, list(config.get_config()))
+    return _connection
+
+def close():
+    # Close the connection to the catalog
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+def _package(row):
+    # Convert a row of the catalog to a tuple (name, repo, version, pkgrel, depends, sha256)
+    # depends is a list of packages, or None if the dependencies are unknown
+    # sha256 is None if the checksum is unknown
+    if row is None:
+        return None
+    depends = row[4]
+    if depends is not None:
+        depends = [dep for dep in depends.split(",") if dep != ""]
+    return (row[0], row[1], row[2], row[3], depends, row[5])
+
+def lookup(name: str):
+    # Returns a tuple (name, repo, version, pkgrel, depends, sha256) for a package
+    # Returns None if the package isn't in any repository
+    return _package(open_catalog().execute("SELECT name, repo, version, pkgrel, depends, sha256 FROM packages WHERE name = ?", (name,)).fetchone())
+
+def get_packages():
+    # Returns a list of tuples (name, repo, version, pkgrel, depends, sha256) of all the packages
+    return [_package(row) for row in open_catalog().execute("SELECT name, repo, version, pkgrel, depends, sha256 FROM packages ORDER BY priority, rowid")]
+
+def get_repos():
+    # Returns the set of the repositories in the catalog
+    return set(row[0] for row in open_catalog().execute("SELECT DISTINCT repo FROM packages"))
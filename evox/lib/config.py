@@ -2,11 +2,12 @@
 # and their URL
 
 import os
-
-import lib.log as log
+from functools import lru_cache
 
 from lib.root import *
 
+# The config file is only read the first time it's needed, and only once
+@lru_cache(maxsize=None)
 def get_config():
     # We get the ROOT environment variable
     if not "ROOT" in os.environ:
@@ -39,4 +40,33 @@ def get_config():
     config_file.close()
 
     # We return the repos dictionary
-    return repos
\ No newline at end of file
+    return repos
+
+@lru_cache(maxsize=None)
+def get_options():
+    # Returns a dictionary of the options of the config file
+    # An option is a line with the following format:
+    # <OPTION> <value>
+    # For example: PARALLEL_DOWNLOADS 4
+    if not "ROOT" in os.environ:
+        root = "/"
+    else:
+        root = os.environ["ROOT"]
+
+    options = {}
+
+    with open(root + "/etc/evox.conf", "r") as config_file:
+        for line in config_file:
+            line = line.split()
+
+            # We skip the empty lines, the comments and the repositories
+            if len(line) < 2 or line[0][0] == "#" or line[0] == "REPO":
+                continue
+
+            options[line[0]] = line[1]
+
+    return options
+
+def get_option(name: str, default=None):
+    # Returns the value of an option, or the default value if it isn't set
+    return get_options().get(name, default)
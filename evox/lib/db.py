@@ -4,157 +4,271 @@
 # <package name> <version> <date>
 
 import os
+import fcntl
+
+import lib.log as log
+import lib.pkgindex as pkgindex
 
 from lib.root import *
 
+# The remote functions read the catalog (lib.catalog), it's only imported when they are called,
+# so the commands that only read the installed packages (info, tree...) start faster
+
 DB = root + "/var/evox/packages/DB"
+
+# The local DB is parsed only once per process, into an index keyed by package name.
+# Each value is the tuple (name, version, date), in the same order as in the DB file.
+# Every write goes through this index and is then written back atomically.
+_local_index = None
+
+# Inside a transaction (see begin), the changes are only kept in the index and in the journal
+# (/var/evox/packages/DB.journal), and the DB file is written once by commit.
+# The journal has one line per change:
+# register <name> <version> <date>
+# unregister <name>
+# Each line is synced to the disk when it's written, so if evox is killed before commit, the next transaction
+# rolls the complete lines forward into the DB and rolls back the last one if it has only been half-written.
+#
+# Only one evox can change the DB at a time: a transaction holds a lock on /var/evox/packages/DB.lock
+# from begin to commit. The other evox only read the DB: they apply the journal to what they read,
+# in memory, and never write it (they may not be allowed to).
+JOURNAL = DB + ".journal"
+LOCK = DB + ".lock"
+_transaction_depth = 0
+_journal = None
+_lock_file = None
+
+def _sync_write(path: str, lines: list):
+    # Write a file and sync it to the disk before renaming it over path,
+    # so the file is never left half-written, even after a power loss
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        for line in lines:
+            f.write(line + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _lock():
+    # Wait until no other evox is changing the DB, and take the lock
+    global _lock_file
+    _lock_file = open(LOCK, "a")
+    try:
+        fcntl.flock(_lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        log.log_info("Waiting for another evox to finish...")
+        fcntl.flock(_lock_file, fcntl.LOCK_EX)
+
+def _unlock():
+    global _lock_file
+    if _lock_file is not None:
+        fcntl.flock(_lock_file, fcntl.LOCK_UN)
+        _lock_file.close()
+        _lock_file = None
+
+def _replay(index: dict):
+    # Apply the journal of a transaction (running, or interrupted) to the index, in memory
+    if not os.path.isfile(JOURNAL):
+        return
+    with open(JOURNAL, "r") as f:
+        for line in f:
+            # The last change hasn't been completely written, we roll it back
+            if not line.endswith("\n"):
+                break
+            change = line.split()
+            if len(change) == 4 and change[0] == "register":
+                index[change[1]] = tuple(change[1:])
+            elif len(change) == 2 and change[0] == "unregister":
+                index.pop(change[1], None)
+
+def _load_local():
+    # Load the local DB file into the index if it isn't loaded yet
+    # Returns the index
+    global _local_index
+    if _local_index is None:
+        _local_index = {}
+        if os.path.isfile(DB):
+            with open(DB, "r") as f:
+                for line in f:
+                    pkg = tuple(line.split())
+                    if len(pkg) > 0:
+                        _local_index[pkg[0]] = pkg
+        _replay(_local_index)
+    return _local_index
+
+def _write_local(change: str = None):
+    # Write the index back to the local DB file
+    # Inside a transaction, we only add the change to the journal
+    global _journal
+    if _transaction_depth > 0:
+        if change is not None:
+            if _journal is None:
+                _journal = open(JOURNAL, "a")
+            _journal.write(change + "\n")
+            _journal.flush()
+            os.fsync(_journal.fileno())
+        return
+    # Outside a transaction, we still wait for the one that may be running
+    _lock()
+    try:
+        _sync_write(DB, [" ".join(pkg) for pkg in _load_local().values()])
+    finally:
+        _unlock()
+
+def begin():
+    # Start a transaction: the next changes to the local DB are written all at once by commit
+    # Transactions can be nested, only the outermost commit writes the DB
+    global _local_index, _transaction_depth
+    if _transaction_depth == 0:
+        _lock()
+        # We read the DB again now that nobody else can change it, and if a transaction
+        # has been interrupted, we roll its journal forward into the DB
+        _local_index = None
+        _load_local()
+        # The index of the installed packages may have been opened read-only, we open it again to write it
+        pkgindex.close()
+        if os.path.isfile(JOURNAL):
+            _sync_write(DB, [" ".join(pkg) for pkg in _local_index.values()])
+            os.remove(JOURNAL)
+    _transaction_depth += 1
+
+def commit():
+    # End a transaction, write its changes to the local DB file and release the lock
+    global _transaction_depth, _journal
+    if _transaction_depth == 0:
+        return
+    _transaction_depth -= 1
+    if _transaction_depth > 0:
+        return
+
+    if _journal is not None:
+        _journal.close()
+        _journal = None
+        _sync_write(DB, [" ".join(pkg) for pkg in _load_local().values()])
+        # The DB has all the changes, the journal isn't needed anymore
+        os.remove(JOURNAL)
+    _unlock()
+
+def init_local():
+    # Create an empty local DB file
+    global _local_index
+    _local_index = {}
+    _write_local()
+
 def read_local():
     # Read the local DB file
     # Returns a list of tuples (name, version, date)
     # If the DB file doesn't exist, it returns an empty list
-    db = []
-    if os.path.isfile(DB):
-        with open(DB, "r") as f:
-            for line in f.readlines():
-                db.append(tuple(line.split()))
-    return db
+    return list(_load_local().values())
+
+def get_local_package(name: str):
+    # Returns the tuple (name, version, date) of an installed package
+    # Returns None if the package isn't installed
+    return _load_local().get(name)
+
+def is_installed(name: str):
+    # Check if a package is registered in the local DB
+    return name in _load_local()
 
 def register_local(name: str, version: str, date: str):
     # Register a package in the local DB file
-
-    with open(DB, "a") as f:
-        f.write(name + " " + version + " " + date + "\n")
+    _load_local()[name] = (name, version, date)
+    _write_local("register " + name + " " + version + " " + date)
 
 def unregister_local(name: str):
     # Unregister a package from the local DB file
-
-    db = read_local()
-    with open(DB, "w") as f:
-        for pkg in db:
-            if pkg[0] != name:
-                f.write(pkg[0] + " " + pkg[1] + " " + pkg[2] + "\n")
+    index = _load_local()
+    if name in index:
+        del index[name]
+        _write_local("unregister " + name)
 
 def update_local(name: str, version: str, date: str):
     # Update a package in the local DB file
-
-    db = read_local()
-    with open(DB, "w") as f:
-        for pkg in db:
-            if pkg[0] != name:
-                f.write(pkg[0] + " " + pkg[1] + " " + pkg[2] + "\n")
-            else:
-                f.write(name + " " + version + " " + date + "\n")
+    index = _load_local()
+    if name in index:
+        index[name] = (name, version, date)
+        _write_local("register " + name + " " + version + " " + date)
 
 def read_remote(repo: str):
-    # Read the remote DB file (/var/evox/repos/<repo>/DB)
-    # The remote DB file has the following format:
-    # <package name> <version>
-    # Returns a list of tuples (name, version)
+    # Read the remote DB file (/var/evox/repos/<repo>/INDEX)
+    # Returns a list of tuples (name, version, pkgrel, fields)
     # If the DB file doesn't exist, it returns an empty list
-    db = []
-    if os.path.isfile(root + "/var/evox/repos/" + repo + "/INDEX"):
-        with open(root + "/var/evox/repos/" + repo + "/INDEX", "r") as f:
-            for line in f.readlines():
-                db.append(tuple(line.split()))
-    return db
+    import lib.catalog as catalog
+    return catalog.read_index(repo)
 
 def get_installed_packages():
-    # Returns a list of installed packages
-    db = read_local()
+    # Returns a dictionary of installed packages and their version
     packages = {}
-    for pkg in db:
+    for pkg in _load_local().values():
         packages[pkg[0]] = pkg[1]
     return packages
 
 def is_package_dependency(name: str, package: str = None):
-    # Check if a package is a dependency of another package
+    # Check if a package is a dependency of another package than package
     # Returns True if it is, False if it isn't
-    db = read_local()
-    for pkg in db:
-        if package != None:
-            if pkg[0] == package:
-                continue
-            if os.path.isfile(root + "/var/evox/packages/" + pkg[0] + "/PKGDEPS"):
-                with open(root + "/var/evox/packages/" + pkg[0] + "/PKGDEPS", "r") as f:
-                    for line in f.readlines():
-                        if line.strip() == name:
-                            return True
+    # We use the reverse dependency index instead of reading the PKGDEPS file of every package
+    for rdep in pkgindex.get_rdeps(name):
+        if rdep != package:
+            return True
     return False
 
 def get_remote_package_version(name: str):
-    # Get the version of a package in the remote DB file
-    # Returns the version if the package is in the DB file
-    # Returns None if the package isn't in the DB file
-    # Loop through all the repositories
-    for repo in os.listdir(root + "/var/evox/repos"):
-        db = read_remote(repo)
-        # Loop through all the packages in the repository
-        for pkg in db:
-            # Check if the package is the one we're looking for
-            if pkg[0] == name:
-                # If it is, return the version
-                return pkg[1]
+    # Get the version of a package in the remote catalog
+    # Returns the version if the package is in the catalog
+    # Returns None if the package isn't in the catalog
+    import lib.catalog as catalog
+    pkg = catalog.lookup(name)
+    if pkg is not None:
+        return pkg[2]
 
 def get_remote_packages():
-    # Returns a list of tuples (name, version) of all the packages in the remote DB files
+    # Returns a list of tuples (name, version, pkgrel) of all the packages in the remote catalog
+    import lib.catalog as catalog
     packages = []
-    # Loop through all the repositories
-    for repo in os.listdir(root + "/var/evox/repos"):
-        db = read_remote(repo)
-        # Loop through all the packages in the repository
-        for pkg in db:
-            # Check if the package is already in the list
-            found = False
-            for package in packages:
-                if package[0] == pkg[0]:
-                    found = True
-                    break
-            # If it isn't, add it to the list
-            if not found:
-                packages.append(pkg)
+    for pkg in catalog.get_packages():
+        packages.append((pkg[0], pkg[2], str(pkg[3])))
     return packages
 
+def get_remote_package_pkgrel(package: str):
+    # Get the pkgrel of a package in the remote catalog
+    # Returns None if the package isn't in the catalog
+    import lib.catalog as catalog
+    pkg = catalog.lookup(package)
+    if pkg is not None:
+        return pkg[3]
+
 def get_local_package_info(package: str):
+    # Returns a dictionary with the info of an installed package (its PKGINFO file)
+    # It's read from the metadata store (see lib/pkgindex.py), not from the PKGINFO file
+    return pkgindex.get_info(package)
+
+def get_local_package_pkgrel(package: str):
+    # Returns the package release of an installed package
+    # The pkgrel is a field of the PKGINFO
+    pkgrel = pkgindex.get_info(package).get("pkgrel")
+    return int(pkgrel) if pkgrel is not None else None
+
+def get_local_package_pkgdeps(package: str):
+    # Returns the list of the dependencies of an installed package (its PKGDEPS file)
+    return pkgindex.get_depends(package)
+
+def get_local_package_pkgtree(package: str):
+    # Returns the list of the files of an installed package (its PKGTREE file)
+    return pkgindex.get_files(package)
+
+def read_local_package_info(package: str):
     # Read /var/evox/packages/<package>/PKGINFO
     # Returns a dictionary with the package info
+    # The files of the package directory are only read to import a package into the metadata store
     info = {}
     if os.path.isfile(root + "/var/evox/packages/" + package + "/PKGINFO"):
         with open(root + "/var/evox/packages/" + package + "/PKGINFO", "r") as f:
             for line in f.readlines():
-                info[line.split(" = ")[0]] = line.split(" = ")[1].strip()
+                if " = " in line:
+                    info[line.split(" = ")[0]] = line.split(" = ")[1].strip()
     return info
 
-def get_local_package_pkgrel(package: str):
-    # Read /var/evox/packages/<package>/PKGREL
-    # Returns the package release
-    # The pkgrel is a field in the PKGINFO file
-    # So we need to read the PKGINFO file to get the pkgrel
-    pkgrel = None
-    if os.path.isfile(root + "/var/evox/packages/" + package + "/PKGINFO"):
-        with open(root + "/var/evox/packages/" + package + "/PKGINFO", "r") as f:
-            for line in f.readlines():
-                if line.split(" = ")[0] == "pkgrel":
-                    pkgrel = int(line.split(" = ")[1].strip())
-
-    return pkgrel
-
-def get_remote_package_pkgrel(package: str):
-    # We read the pkgrel of a remote package in the INDEX file
-    # The INDEX file has the following format:
-    # <package name> <version> <pkgrel>
-    # So we need to read the INDEX file to get the pkgrel
-    pkgrel = None
-    # Loop through all the repositories
-    for repo in os.listdir(root + "/var/evox/repos"):
-        if os.path.isfile(root + "/var/evox/repos/" + repo + "/INDEX"):
-            with open(root + "/var/evox/repos/" + repo + "/INDEX", "r") as f:
-                for line in f.readlines():
-                    if line.split()[0] == package:
-                        pkgrel = int(line.split()[2])
-
-    return pkgrel
-
-def get_local_package_pkgdeps(package: str):
+def read_local_package_pkgdeps(package: str):
     # Read /var/evox/packages/<package>/PKGDEPS
     # Returns a list of dependencies
     deps = []
@@ -162,4 +276,14 @@ def get_local_package_pkgdeps(package: str):
         with open(root + "/var/evox/packages/" + package + "/PKGDEPS", "r") as f:
             for line in f.readlines():
                 deps.append(line.strip())
-    return deps
\ No newline at end of file
+    return deps
+
+def read_local_package_pkgtree(package: str):
+    # Read /var/evox/packages/<package>/PKGTREE
+    # Returns a list of the files of the package
+    tree = []
+    if os.path.isfile(root + "/var/evox/packages/" + package + "/PKGTREE"):
+        with open(root + "/var/evox/packages/" + package + "/PKGTREE", "r") as f:
+            for line in f.readlines():
+                tree.append(line.strip())
+    return tree
@@ -1,10 +1,14 @@
 import os
-from lib.addpkg import addpkg
+import lib.addpkg as addpkg
 import lib.db as db
+import lib.pkgindex as pkgindex
 import lib.log as log
 import lib.readevx as readevx
 import lib.net as net
 import lib.config as config
+import lib.resolver as resolver
+import lib.scheduler as scheduler
+import lib.transaction as transaction
 
 from urllib.parse import urlparse
 from lib.root import *
@@ -17,16 +21,109 @@ def is_url(url):
     return False
 
 def is_package_installed(package: str):
-    # We get the list of installed packages
-    installed_packages = db.get_installed_packages()
+    # We look the package up in the local DB index
+    return db.is_installed(package)
+
+def install_transaction(transaction: list, packages: list, auto_accept: bool = False, jobs: int = 1):
+    # Install a transaction computed by resolver.resolve, in its order
+    # packages are the packages asked by the user, the other ones are installed as dependencies
+    # jobs is the number of packages that can be unpacked at the same time
+    actions = [entry for entry in transaction if entry[0] != "skip"]
+    if len(actions) == 0:
+        return
+
+    # We display the whole transaction and ask the user before installing anything
+    deps = [name + "-" + version for action, name, version, pkgrel, repo in actions if name not in packages]
+    if len(deps) > 0:
+        log.log_info("The following dependencies will be installed: " + " ".join(deps))
+        print()
 
-    # We check if the package is in the list
-    if package in installed_packages:
-        # If it is, we return True
-        return True
+        if not auto_accept:
+            if not log.log_ask("Do you want to continue?"):
+                # The resolver may have downloaded some packages to read their dependencies
+                for action, name, version, pkgrel, repo in actions:
+                    if os.path.exists(resolver.get_package_path(repo, name, version)):
+                        os.remove(resolver.get_package_path(repo, name, version))
+                return
+            # The user has accepted the whole transaction
+            auto_accept = True
+
+    # We download all the packages at the same time, and check them all before installing the first one
+    resolver.fetch(transaction)
+    check_transaction(transaction)
+
+    for (action, name, version, pkgrel, repo), stagedir in scheduler.schedule(transaction, jobs):
+        path = resolver.get_package_path(repo, name, version)
+
+        if name not in packages:
+            # Log an info message
+            log.log_info("Installing dependency " + name + "...")
+
+        # The dependencies are already in the transaction, before the package
+        install_file(path, name not in packages, auto_accept=auto_accept, check_deps=False, check_conflicts=False, upgrade=action == "upgrade", stagedir=stagedir)
+
+        if name not in packages:
+            # Log a success message
+            log.log_success("Dependency " + name + " installed successfully!")
+
+        # We remove the package
+        os.remove(path)
+
+def find_transaction_conflicts(transaction: list):
+    # Returns a list of tuples (package, path, owner) for the files that the packages of a transaction would overwrite:
+    # the files of the installed packages (see pkgindex.find_conflicts), and the files of the other packages of the transaction
+    # The packages must have been fetched. The files that the old version of a package upgraded in the transaction
+    # doesn't have anymore can be taken by another package of the transaction
+    trees = {}
+    released = set()
+    for action, name, version, pkgrel, repo in transaction:
+        if action == "skip":
+            continue
+        tree = [path for path in map(pkgindex.normalize, readevx.readevx(resolver.get_package_path(repo, name, version), name).get("tree", [])) if path != ""]
+        trees[name] = tree
+        if is_package_installed(name):
+            new_tree = set(tree)
+            released.update((path, name) for path in pkgindex.get_files(name) if path not in new_tree)
+
+    # The directories of the packages (the paths with other paths under them) can be shared
+    directories = set()
+    for tree in trees.values():
+        for path in tree:
+            parent = os.path.dirname(path)
+            while parent != "" and parent not in directories:
+                directories.add(parent)
+                parent = os.path.dirname(parent)
+
+    conflicts = []
+    owners = {}
+    for name, tree in trees.items():
+        for path, owner in pkgindex.find_conflicts(name, tree, released):
+            conflicts.append((name, path, owner))
+        for path in tree:
+            if path in owners and path not in directories and not os.path.isdir(os.path.join(root, path)):
+                conflicts.append((name, path, owners[path]))
+            owners.setdefault(path, name)
+    return conflicts
+
+def check_transaction(transaction: list):
+    # Check that the packages of a transaction don't overwrite the files of other packages, before installing anything
+    # If they do, we remove the downloaded packages and exit
+    conflicts = find_transaction_conflicts(transaction)
+    if len(conflicts) == 0:
+        return
+
+    for name, path, owner in conflicts:
+        log_conflict(name, path, owner)
+    for action, name, version, pkgrel, repo in transaction:
+        if action != "skip" and os.path.exists(resolver.get_package_path(repo, name, version)):
+            os.remove(resolver.get_package_path(repo, name, version))
+    exit(1)
+
+def log_conflict(package: str, path: str, owner: str):
+    if owner is None:
+        log.log_error("Package " + package + " needs a directory /" + path + ", but it's a file!")
     else:
-        # If it isn't, we return False
-        return False
+        log.log_error("File /" + path + " of package " + package + " is already owned by package " + owner + "!")
 
 def install_pkg(package: str, is_dep: bool = False, auto_accept: bool = False, check_deps: bool = True, upgrade: bool = False):
     current_dir = os.getcwd()
@@ -94,56 +191,11 @@ def install_pkg(package: str, is_dep: bool = False, auto_accept: bool = False, c
                     log.log_error("Repository " + repo + " doesn't exist! (Maybe you have not synced it)")
                     exit(1)
 
-            package_found = False
-                            
-            # We loop through the repositories
-            for repo in repos:
-                # We get the URL of the repository
-                url = repos[repo]["url"]
-                # The path of the repository is /var/evox/repos/repo
-                path = os.path.join(root, "var/evox/repos/" + repo)
-
-                # We get the index of the repository
-                index = open(path + "/INDEX", "r")
+            # We compute the whole transaction, with the missing dependencies
+            plan = resolver.resolve([package], upgrade=upgrade)
 
-                # We get the list of packages in the repository
-                packages = index.read().splitlines()
-
-                # We loop through the packages
-                for pkg in packages:
-                    # We get the name of the package
-                    pkg_name = pkg.split(" ")[0]
-
-                    # We check if the package is the one we want
-                    if pkg_name == package:
-                        # If it is, we get the version of the package
-                        pkg_version = pkg.split(" ")[1]
-
-                        # We get the path of the package
-                        pkg_path = path + "/" + pkg_name + "-" + pkg_version + ".evx"
-
-                        # We download the package
-                        net.download(url + "/" + pkg_name + "-" + pkg_version + ".evx", pkg_path, True)
-
-                        # We install the package
-                        install_file(pkg_path, is_dep, auto_accept=auto_accept, check_deps=check_deps, upgrade=upgrade)
-
-                        # We remove the package
-                        os.remove(pkg_path)
-
-                        # We set the package_found variable to True
-                        package_found = True
-
-                        # We break the loop
-                        break
-
-                if package_found:
-                    break
-
-            # If the package is not found, we log an error
-            if not package_found:
-                log.log_error("Package " + package + " not found in repositories!")
-                exit(1)
+            # And we install it
+            install_transaction(plan, [] if is_dep else [package], auto_accept=auto_accept)
 
     # To end, we display a message
     if not is_dep and is_package_installed(package) and not upgrade:
@@ -151,7 +203,10 @@ def install_pkg(package: str, is_dep: bool = False, auto_accept: bool = False, c
 
     os.chdir(current_dir)
 
-def install_file(package: str, is_dep: bool = False, auto_accept: bool = False, check_deps: bool = True, upgrade: bool = False):
+def install_file(package: str, is_dep: bool = False, auto_accept: bool = False, check_deps: bool = True, check_conflicts: bool = True, upgrade: bool = False, stagedir: str = None):
+    # If the package has already been staged by addpkg.stagepkg, stagedir is its staging directory
+    # check_conflicts is False when the package is part of a transaction that has already been checked (see check_transaction)
+    # Returns the tuple (added, replaced, removed) of the commit (see transaction.commit), or None if the package isn't installed
     path = package
 
     if not is_dep:
@@ -180,33 +235,42 @@ def install_file(package: str, is_dep: bool = False, auto_accept: bool = False,
         # We add a blank line
         print()
 
+    # We check that the package doesn't overwrite the files of another package
+    conflicts = pkgindex.find_conflicts(pkginfo["name"], pkginfo.get("tree", [])) if check_conflicts else []
+    if len(conflicts) > 0:
+        for path, owner in conflicts:
+            log_conflict(pkginfo["name"], path, owner)
+        if stagedir is not None:
+            transaction.rollback(stagedir)
+        exit(1)
+
     # We ask the user if he wants to install the package
     if is_dep or auto_accept or log.log_ask("Do you want to install this package?"):
         # For each dependency, we check if it's installed
         if "depends" in pkginfo and check_deps:
             # Log an info message
-            installed_deps = []
             log.log_info("Checking dependencies...")
-            for dep in pkginfo["depends"]:
-                # If it's not installed, we install it
-                if not is_package_installed(dep):
-                    # Log an info message
-                    log.log_info("Installing dependency " + dep + "...")
-                    install_pkg(dep, is_dep=True)
-                    # Log a success message
-                    log.log_success("Dependency " + dep + " installed successfully!")
-                    installed_deps.append(dep)
+            installed_deps = [dep for dep in pkginfo["depends"] if not is_package_installed(dep)]
+
+            # We install the missing ones, with their own dependencies
+            install_transaction(resolver.resolve(installed_deps), [], auto_accept=True)
 
             print()
-            
+
             # Log an info message
             if len(installed_deps) > 0:
                 log.log_info("Dependencies installed successfully!")
                 print()
             log.log_info("Installing package " + pkginfo["name"] + "...")
                 
-        # We just call the addpkg function
-        addpkg(os.path.abspath(path), pkginfo["name"], pkginfo)
+        # We just call the addpkg function, or commit the staged package
+        # We return the files added, replaced and removed by the commit
+        if stagedir is None:
+            return addpkg.addpkg(os.path.abspath(path), pkginfo["name"], pkginfo)
+        else:
+            return addpkg.commitpkg(stagedir, pkginfo["name"], pkginfo)
+    elif stagedir is not None:
+        transaction.rollback(stagedir)
 
 def log_installed():
     log.log_error("This package is already installed.")
@@ -1,47 +1,287 @@
-import sys, os, shutil
-from urllib import request
+import sys, os, re, shutil, threading
+import http.client
+from urllib import request, error
+from urllib.parse import urlparse, urljoin
+from concurrent.futures import ThreadPoolExecutor
 import lib.log as log
+import lib.config as config
+import lib.cache as cache
+import lib.profile as profile
 
-def download(link, file_name, dl_log=True):
-    if os.path.exists(link):
-        if os.path.exists(file_name):
-            if not os.path.samefile(link, file_name):
-                shutil.copyfile(link, file_name)
+# Each thread keeps one HTTP connection open per host, so downloading several
+# files from the same mirror doesn't open a new connection for each file
+_thread_data = threading.local()
+
+def _get_proxy(url):
+    # Returns the proxy to use for a link (parsed by urlparse), parsed too, or None
+    # The proxies are given by the environment (http_proxy, https_proxy and no_proxy), like for urllib
+    proxy = request.getproxies().get(url.scheme)
+    if proxy is None or request.proxy_bypass(url.hostname or ""):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    return urlparse(proxy)
+
+def _get_connection(scheme, host, proxy=None):
+    if not hasattr(_thread_data, "connections"):
+        _thread_data.connections = {}
+
+    if (scheme, host) not in _thread_data.connections:
+        # Through a proxy, we connect to the proxy: an HTTPS connection goes through a tunnel to host,
+        # and the HTTP requests are sent to the proxy with the whole link
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(proxy.netloc if proxy is not None else host, timeout=60)
+            if proxy is not None:
+                connection.set_tunnel(host)
         else:
+            connection = http.client.HTTPConnection(proxy.netloc if proxy is not None else host, timeout=60)
+        _thread_data.connections[(scheme, host)] = connection
+
+    return _thread_data.connections[(scheme, host)]
+
+def _drop_connection(scheme, host):
+    connection = _thread_data.connections.pop((scheme, host), None)
+    if connection is not None:
+        connection.close()
+
+def open_url(link, redirects=5, headers={}, method="GET"):
+    # Open a link and return the response
+    # HTTP(S) links go through the connections of the current thread, the other ones through urllib
+    # The proxies that need a password or aren't HTTP proxies are left to urllib too
+    url = urlparse(link)
+    proxy = _get_proxy(url) if url.scheme in ("http", "https") else None
+    if url.scheme not in ("http", "https") or (proxy is not None and (proxy.username is not None or proxy.scheme != "http")):
+        return request.urlopen(request.Request(link, headers=headers, method=method))
+
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    if proxy is not None and url.scheme == "http":
+        path = url.scheme + "://" + url.netloc + path
+
+    # If the server closed our idle connection, we retry once with a new one
+    for attempt in range(2):
+        connection = _get_connection(url.scheme, url.netloc, proxy)
+        try:
+            connection.request(method, path, headers=headers)
+            response = connection.getresponse()
+            break
+        except (http.client.HTTPException, ConnectionError):
+            _drop_connection(url.scheme, url.netloc)
+            if attempt == 1:
+                raise
+
+    if response.status in (301, 302, 303, 307, 308) and redirects > 0:
+        location = urljoin(link, response.getheader("Location"))
+        response.read()
+        return open_url(location, redirects - 1, headers, method)
+
+    if response.status >= 400:
+        response.read()
+        raise error.HTTPError(link, response.status, response.reason, response.headers, None)
+
+    return response
+
+def download(link, file_name, dl_log=True, sha256=None):
+    # Download a single file
+    # If sha256 is given, the file is checked against it
+    return download_many([(link, file_name, sha256)], dl_log)
+
+def _print_progress(progress):
+    bar = "["
+    bar_size = 25
+    if progress["size"] > 0:
+        bar_progress = min(int(progress["size_dl"] / progress["size"] * bar_size), bar_size)
+        percent = min(int(progress["size_dl"] / progress["size"] * 100), 100)
+    else:
+        bar_progress = 0
+        percent = 0
+    bar += "#" * bar_progress
+    bar += "-" * (bar_size - bar_progress)
+    bar += "]"
+
+    sys.stdout.write("\r" + bar + " " + str(percent) + "% (" + str(progress["files_dl"]) + "/" + str(progress["files"]) + " files)")
+    sys.stdout.flush()
+
+def _add_progress(progress, size=0, size_dl=0):
+    with progress["lock"]:
+        progress["size"] += size
+        progress["size_dl"] += size_dl
+        if progress["log"]:
+            _print_progress(progress)
+
+def _fetch_range(link, file_name, start, end, progress):
+    # Download the bytes from start to end (included, or to the end of the file if end is None) of link to file_name
+    # If file_name already has the beginning of these bytes, we only download the rest of them
+    # On a network error, or if the connection is closed before the end of the response, we retry
+    # and resume where we stopped (DOWNLOAD_RETRIES times, 3 by default)
+    retries = int(config.get_option("DOWNLOAD_RETRIES", 3))
+    counted = False
+
+    for attempt in range(retries + 1):
+        offset = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+        if end is not None and start + offset > end:
+            return
+
+        headers = {}
+        if start + offset > 0 or end is not None:
+            headers["Range"] = "bytes=" + str(start + offset) + "-" + ("" if end is None else str(end))
+
+        try:
+            response = open_url(link, headers=headers)
+        except error.HTTPError as e:
+            # The file was already complete
+            if e.code == 416 and end is None and offset > 0:
+                if not counted:
+                    _add_progress(progress, size=offset, size_dl=offset)
+                return
+            raise
+        except (OSError, http.client.HTTPException):
+            if attempt == retries:
+                raise
+            continue
+
+        mode = "ab"
+        if "Range" in headers and getattr(response, "status", 200) != 206:
+            # The server doesn't support ranges, so we get the whole file again
+            if start > 0:
+                raise Exception("The server of " + link + " doesn't support ranges")
+            if counted:
+                _add_progress(progress, size_dl=-offset)
+            offset = 0
+            mode = "wb"
+
+        # The first time, we count the size of the file and what we already have
+        if not counted:
+            file_size = response.info()["Content-Length"]
+            if file_size is not None and end is None:
+                _add_progress(progress, size=int(file_size) + offset, size_dl=offset)
+            elif end is not None:
+                _add_progress(progress, size_dl=offset)
+            counted = True
+
+        # The size file_name must have at the end of the response, when the server gives it
+        # http.client doesn't check it: a response cut by the network just ends early
+        expected = None
+        content_range = re.match(r"bytes \d+-(\d+)/", response.info()["Content-Range"] or "")
+        if response.info()["Content-Length"] is not None:
+            expected = offset + int(response.info()["Content-Length"])
+        elif mode == "ab" and content_range is not None:
+            expected = int(content_range.group(1)) - start + 1
+        elif end is not None:
+            expected = end - start + 1
+
+        try:
+            with open(file_name, mode) as f:
+                while True:
+                    buffer = response.read(65536)
+                    if not buffer:
+                        break
+                    f.write(buffer)
+                    _add_progress(progress, size_dl=len(buffer))
+                    profile.count("bytes downloaded", len(buffer))
+            size = os.path.getsize(file_name)
+            if expected is not None and size < expected:
+                raise http.client.IncompleteRead(b"", expected - size)
+            return
+        except (OSError, http.client.HTTPException):
+            url = urlparse(link)
+            _drop_connection(url.scheme, url.netloc)
+            if attempt == retries:
+                raise
+
+def _get_size(link):
+    # Returns the size of a remote file if the server supports ranges, else None
+    response = open_url(link, method="HEAD")
+    response.read()
+    if response.info().get("Accept-Ranges") != "bytes" or response.info()["Content-Length"] is None:
+        return None
+    return int(response.info()["Content-Length"])
+
+def _fetch_segments(link, part, size, segments, progress):
+    # Download a big file in several segments at the same time, each one in its own file
+    # (<file>.part.<n>) so that each segment can be resumed, then put them together
+    segment_size = -(-size // segments)
+    ranges = [(n * segment_size, min((n + 1) * segment_size, size) - 1) for n in range(segments)]
+    _add_progress(progress, size=size)
+
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(_fetch_range, link, part + "." + str(n), ranges[n][0], ranges[n][1], progress) for n in range(segments)]
+        for future in futures:
+            future.result()
+
+    with open(part, "wb") as out:
+        for n in range(segments):
+            with open(part + "." + str(n), "rb") as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+    for n in range(segments):
+        os.remove(part + "." + str(n))
+
+def _download_job(link, file_name, sha256, progress):
+    # Download one file of a download_many call and update the shared progress
+    # The file is downloaded to <file>.part, and only renamed when it is complete and checked,
+    # so an interrupted download is resumed by the next one
+    if os.path.exists(link):
+        if not os.path.exists(file_name) or not os.path.samefile(link, file_name):
             shutil.copyfile(link, file_name)
-        return True
+        _add_progress(progress, size=os.path.getsize(file_name), size_dl=os.path.getsize(file_name))
+    else:
+        part = file_name + ".part"
 
-    with open(file_name, "wb") as f:
-        if dl_log:
-            log.log_info("Downloading " + link + "...")
-        
-        response = request.urlopen(link)
-        meta = response.info()
-        file_size = int(meta["Content-Length"])
-        file_size_dl = 0
-        block_sz = 4096
+        # Big files can be downloaded in several segments at the same time (DOWNLOAD_SEGMENTS, 1 by default),
+        # when they are bigger than SEGMENT_MIN_SIZE MiB (64 by default)
+        segments = int(config.get_option("DOWNLOAD_SEGMENTS", 1))
+        size = None
+        if segments > 1 and not os.path.exists(part):
+            size = _get_size(link)
 
-        while True:
-            buffer = response.read(block_sz)
-            if not buffer:
-                break
+        if size is not None and size >= int(config.get_option("SEGMENT_MIN_SIZE", 64)) * 1024 * 1024:
+            _fetch_segments(link, part, size, segments, progress)
+        else:
+            _fetch_range(link, part, 0, None, progress)
+
+        # We check the file before using it
+        if sha256 is not None and cache.hash_file(part) != sha256:
+            os.remove(part)
+            raise Exception("The checksum of " + link + " doesn't match, the file is corrupted")
+
+        os.replace(part, file_name)
+
+    with progress["lock"]:
+        progress["files_dl"] += 1
+        if progress["log"]:
+            _print_progress(progress)
+
+def download_many(downloads: list, dl_log=True):
+    # Download several files at the same time
+    # downloads is a list of tuples (link, file_name) or (link, file_name, sha256)
+    # The number of parallel downloads is set by the PARALLEL_DOWNLOADS option of the config file
+    if len(downloads) == 0:
+        return True
 
-            file_size_dl += len(buffer)
-            f.write(buffer)
+    jobs = int(config.get_option("PARALLEL_DOWNLOADS", 4))
 
-            if dl_log:
-                bar = "["
-                bar_size = 25
-                bar_progress = int(file_size_dl / file_size * bar_size)
-                bar += "#" * bar_progress
-                bar += "-" * (bar_size - bar_progress)
-                bar += "]"
+    progress = {"lock": threading.Lock(), "size": 0, "size_dl": 0, "files": len(downloads), "files_dl": 0, "log": dl_log}
 
-                percent = int(file_size_dl / file_size * 100)
+    if dl_log:
+        if len(downloads) == 1:
+            log.log_info("Downloading " + downloads[0][0] + "...")
+        else:
+            log.log_info("Downloading " + str(len(downloads)) + " files...")
 
-                sys.stdout.write("\r" + bar + " " + str(percent) + "%")
+    with profile.span("download"), ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = []
+        for download in downloads:
+            sha256 = download[2] if len(download) > 2 else None
+            futures.append(executor.submit(_download_job, download[0], download[1], sha256, progress))
+        # We wait for all the downloads, and raise the first error if there is one
+        for future in futures:
+            future.result()
+    profile.count("files downloaded", len(downloads))
 
     if dl_log:
         print()
         log.log_success("Done!")
-        print()
\ No newline at end of file
+        print()
+
+    return True
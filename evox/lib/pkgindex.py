@@ -0,0 +1,207 @@
+# pkgindex module maintains indexes about the installed packages in a SQLite database (/var/evox/PKGINDEX)
+# It's also the metadata store of the installed packages: their PKGINFO, PKGDEPS and PKGTREE files
+# are all read from it, with a single open, instead of reading the files of each package directory.
+#
+# The info table has the PKGINFO of each package, as a JSON object:
+# <package> <info>
+#
+# The files table maps each path of the PKGTREE files to the packages owning it:
+# <path> <package>
+# The paths are stored relative to the root, without a leading or trailing slash.
+# A directory can be owned by several packages.
+#
+# The depends table is the reverse dependency index, it maps each dependency
+# of the PKGDEPS files to the packages requiring it:
+# <dependency> <package>
+#
+# The index is updated by addpkg and rmpkg. If it doesn't exist yet (or has an older format), it's built
+# from the PKGINFO, PKGTREE and PKGDEPS files of the installed packages, which are kept as the import source.
+# Only the evox holding the lock of the local DB (see db.begin) writes the index. The other ones (info, tree,
+# owns... and the normal users) open it read-only, and build it in memory when it can't be used.
+
+import os
+import json
+import sqlite3
+from urllib.parse import quote
+
+import lib.db as db
+
+from lib.root import *
+
+PKGINDEX = root + "/var/evox/PKGINDEX"
+# The version of the index format, bumped each time the format changes
+PKGINDEX_VERSION = 3
+
+# The connection is opened only once per process
+_connection = None
+
+def normalize(path: str):
+    # Returns a path as it is stored in the index
+    path = path.strip()
+    while path.startswith("./"):
+        path = path[2:]
+    return path.strip("/")
+
+def _open_read_only():
+    # Returns a read-only connection to the index, or None if it doesn't exist or has an older format
+    if not os.path.isfile(PKGINDEX):
+        return None
+    try:
+        connection = sqlite3.connect("file:" + quote(PKGINDEX) + "?mode=ro", uri=True)
+        if connection.execute("PRAGMA user_version").fetchone()[0] == PKGINDEX_VERSION:
+            return connection
+        connection.close()
+    except sqlite3.Error:
+        pass
+    return None
+
+def is_current():
+    # Check if the index exists and has the current format
+    connection = _open_read_only()
+    if connection is None:
+        return False
+    connection.close()
+    return True
+
+def open_index():
+    # Returns the connection to the index
+    # When we hold the lock of the DB, we open it for writing and build it if needed
+    # Otherwise we only read it, and if it can't be used, we build it in memory without writing anything
+    global _connection
+    if _connection is None:
+        if db._transaction_depth > 0:
+            _connection = sqlite3.connect(PKGINDEX)
+            if _connection.execute("PRAGMA user_version").fetchone()[0] != PKGINDEX_VERSION:
+                rebuild()
+        else:
+            _connection = _open_read_only()
+            if _connection is None:
+                _connection = sqlite3.connect(":memory:")
+                rebuild()
+    return _connection
+
+def close():
+    # Close the connection to the index
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+def rebuild():
+    # Build the index from the metadata of the installed packages
+    connection = _connection
+    connection.execute("DROP TABLE IF EXISTS files")
+    connection.execute("CREATE TABLE files (path TEXT, package TEXT, PRIMARY KEY (path, package)) WITHOUT ROWID")
+    connection.execute("CREATE INDEX files_package ON files (package)")
+    connection.execute("DROP TABLE IF EXISTS depends")
+    connection.execute("CREATE TABLE depends (dependency TEXT, package TEXT, UNIQUE (dependency, package))")
+    connection.execute("CREATE INDEX depends_package ON depends (package)")
+    connection.execute("DROP TABLE IF EXISTS info")
+    connection.execute("CREATE TABLE info (package TEXT PRIMARY KEY, info TEXT)")
+
+    for pkg in db.read_local():
+        _add_files(connection, pkg[0], db.read_local_package_pkgtree(pkg[0]))
+        _add_depends(connection, pkg[0], db.read_local_package_pkgdeps(pkg[0]))
+        _set_info(connection, pkg[0], db.read_local_package_info(pkg[0]))
+
+    connection.execute("PRAGMA user_version = " + str(PKGINDEX_VERSION))
+    connection.commit()
+
+def _add_files(connection, package: str, paths: list):
+    rows = set()
+    for path in paths:
+        path = normalize(path)
+        if path != "":
+            rows.add((path, package))
+    connection.executemany("INSERT OR IGNORE INTO files VALUES (?, ?)", rows)
+
+def get_owners(path: str):
+    # Returns the list of the packages owning a path
+    return [row[0] for row in open_index().execute("SELECT package FROM files WHERE path = ? ORDER BY package", (normalize(path),))]
+
+def get_shared_files(package: str):
+    # Returns the set of the paths of a package that are also owned by other packages
+    return set(row[0] for row in open_index().execute(
+        "SELECT path FROM files WHERE package = ? AND path IN (SELECT path FROM files WHERE package != ?)", (package, package)))
+
+def find_conflicts(package: str, paths: list, released: set = None):
+    # Returns a list of tuples (path, owner) for the paths of a package that would overwrite
+    # a file of another package
+    # A path shared with another package isn't a conflict if it's a directory on the disk
+    # released is a set of tuples (path, owner) of the files that their owner gives up in the same transaction
+    # (the new version of an upgraded package doesn't have them anymore), they aren't conflicts either
+    # The directories of the package (the paths with other paths under them) must also be directories
+    # on the disk (or links to directories): if one is a file, it's a conflict, and its owner is None
+    # when no package owns it
+    connection = open_index()
+    conflicts = []
+    parents = set()
+    for path in paths:
+        path = normalize(path)
+        if path == "":
+            continue
+        parent = os.path.dirname(path)
+        while parent != "" and parent not in parents:
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+        for row in connection.execute("SELECT package FROM files WHERE path = ? AND package != ?", (path, package)):
+            if released is not None and (path, row[0]) in released:
+                continue
+            full_path = os.path.join(root, path)
+            if os.path.lexists(full_path) and not os.path.isdir(full_path):
+                conflicts.append((path, row[0]))
+
+    for path in sorted(parents):
+        full_path = os.path.join(root, path)
+        if os.path.lexists(full_path) and not os.path.isdir(full_path) and not any(conflict[0] == path for conflict in conflicts):
+            owners = [owner for owner in get_owners(path) if owner != package]
+            conflicts.append((path, owners[0] if len(owners) > 0 else None))
+    return conflicts
+
+def _add_depends(connection, package: str, depends: list):
+    connection.executemany("INSERT OR IGNORE INTO depends VALUES (?, ?)", [(dep, package) for dep in depends if dep != ""])
+
+def get_rdeps(package: str):
+    # Returns the list of the installed packages requiring a package
+    return [row[0] for row in open_index().execute("SELECT package FROM depends WHERE dependency = ? ORDER BY package", (package,))]
+
+def get_all_depends():
+    # Returns a list of tuples (dependency, package) for all the installed packages
+    return open_index().execute("SELECT dependency, package FROM depends ORDER BY package, dependency").fetchall()
+
+def get_depends(package: str):
+    # Returns the list of the dependencies of an installed package, in the order of its PKGDEPS file
+    return [row[0] for row in open_index().execute("SELECT dependency FROM depends WHERE package = ? ORDER BY rowid", (package,))]
+
+def get_files(package: str):
+    # Returns the list of the paths owned by an installed package, sorted
+    return [row[0] for row in open_index().execute("SELECT path FROM files WHERE package = ? ORDER BY path", (package,))]
+
+def _set_info(connection, package: str, info: dict):
+    connection.execute("INSERT OR REPLACE INTO info VALUES (?, ?)", (package, json.dumps(info)))
+
+def get_info(package: str):
+    # Returns the PKGINFO of an installed package, as a dictionary (empty if the package isn't installed)
+    row = open_index().execute("SELECT info FROM info WHERE package = ?", (package,)).fetchone()
+    return json.loads(row[0]) if row is not None else {}
+
+def get_all_info():
+    # Returns a dictionary with the PKGINFO of all the installed packages
+    return {row[0]: json.loads(row[1]) for row in open_index().execute("SELECT package, info FROM info")}
+
+def add_package(package: str, info: dict, depends: list, paths: list):
+    # Import the metadata of an installed package (replacing the ones of its previous version)
+    connection = open_index()
+    connection.execute("DELETE FROM files WHERE package = ?", (package,))
+    _add_files(connection, package, paths)
+    connection.execute("DELETE FROM depends WHERE package = ?", (package,))
+    _add_depends(connection, package, depends)
+    _set_info(connection, package, info)
+    connection.commit()
+
+def remove_package(package: str):
+    # Remove all the metadata of a package
+    connection = open_index()
+    for table in ("files", "depends", "info"):
+        connection.execute("DELETE FROM " + table + " WHERE package = ?", (package,))
+    connection.commit()
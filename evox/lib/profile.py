@@ -0,0 +1,128 @@
+# profile module measures where evox spends its time, for `--profile`
+#
+# The code marks its phases with spans:
+#     with profile.span("download"):
+#         ...
+# and counts what it does with counters:
+#     profile.count("bytes downloaded", len(buffer))
+# A span can be given the package it works on, to also get the time spent on each package.
+#
+# Nothing is measured until enable is called, so the spans and the counters cost almost nothing otherwise.
+# If the EVOX_CPROFILE environment variable is set when profiling is enabled, the whole run is also
+# profiled with cProfile, and the statistics are saved to the file it gives (to be read with pstats or snakeviz).
+#
+# The packages staged by other processes (--jobs) are measured in their process, so they aren't in the report:
+# the main process only sees the time it waits for them ("wait for staging").
+
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+_enabled = False
+_lock = None
+_start = None
+_cprofile = None
+
+# name: [number of times, seconds]
+_spans = {}
+# package: {name: seconds}
+_packages = {}
+# name: value
+_counters = {}
+
+def enable():
+    # Start measuring
+    # threading is only imported here, evox starts faster without it
+    import threading
+    global _enabled, _lock, _start, _cprofile
+    _lock = threading.Lock()
+    _enabled = True
+    _start = time.perf_counter()
+    if os.environ.get("EVOX_CPROFILE"):
+        import cProfile
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+@contextmanager
+def span(name: str, package: str = None):
+    # Measure the time spent in a block
+    # The spans can be nested, each one is counted on its own
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            total = _spans.setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+            if package is not None:
+                package_spans = _packages.setdefault(package, {})
+                package_spans[name] = package_spans.get(name, 0.0) + seconds
+
+def count(name: str, value: int = 1):
+    # Add value to a counter
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def summary():
+    # Returns a dictionary with everything that has been measured
+    return {
+        "total": round(time.perf_counter() - _start, 6) if _start is not None else 0,
+        "spans": {name: {"count": total[0], "seconds": round(total[1], 6)} for name, total in _spans.items()},
+        "packages": {package: {name: round(seconds, 6) for name, seconds in spans.items()} for package, spans in _packages.items()},
+        "counters": dict(_counters)
+    }
+
+def report(output_format: str = "text"):
+    # Print what has been measured, as text or as JSON, on the error output
+    # so that it isn't mixed with the output of the command
+    global _cprofile
+    if not _enabled:
+        return
+
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(os.environ["EVOX_CPROFILE"])
+        _cprofile = None
+
+    data = summary()
+    if output_format == "json":
+        import json
+        sys.stderr.write(json.dumps(data, indent=4) + "\n")
+        return
+
+    lines = ["", "Profile (" + str(round(data["total"], 3)) + " s in total):"]
+    # The longest phases first
+    for name, total in sorted(data["spans"].items(), key=lambda item: -item[1]["seconds"]):
+        lines.append("  " + name.ljust(24) + str(round(total["seconds"], 3)).rjust(9) + " s" + str(total["count"]).rjust(8) + "x")
+    if len(data["counters"]) > 0:
+        lines.append("Counters:")
+        for name, value in sorted(data["counters"].items()):
+            lines.append("  " + name.ljust(24) + str(value).rjust(12))
+    if len(data["packages"]) > 0:
+        lines.append("Packages:")
+        # Each span of a package is shown on its own
+        for package, spans in sorted(data["packages"].items()):
+            lines.append("  " + package.ljust(24) + ", ".join(name + " " + str(round(seconds, 3)) + " s" for name, seconds in spans.items()))
+    sys.stderr.write("\n".join(lines) + "\n")
+
+def report_startup(start: float, start_cpu: float, parsed: float):
+    # Print the time spent starting evox, for `--startup-profile`
+    # start is the time when main.py started, start_cpu the CPU time of the process at this moment
+    # (the time python took to start), and parsed the time when the arguments had been parsed
+    end = time.perf_counter()
+    lines = ["", "Startup profile:"]
+    lines.append("  " + "python".ljust(24) + str(round(start_cpu * 1000, 1)).rjust(9) + " ms (CPU time before main.py)")
+    lines.append("  " + "imports and arguments".ljust(24) + str(round((parsed - start) * 1000, 1)).rjust(9) + " ms")
+    lines.append("  " + "command".ljust(24) + str(round((end - parsed) * 1000, 1)).rjust(9) + " ms (with the modules it imports)")
+    lines.append("  " + "modules".ljust(24) + str(len(sys.modules)).rjust(9) + " (" + ", ".join(sorted(name for name in sys.modules if name.startswith("lib."))) + ")")
+    lines.append("Run `python -X importtime` on evox for the time of each import.")
+    sys.stderr.write("\n".join(lines) + "\n")
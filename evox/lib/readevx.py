@@ -1,7 +1,17 @@
 import zstandard as zstd
 import tarfile
-import tempfile
-import os
+
+def iter_members(tar):
+    """Iterates over the members of a tar stream without keeping them in memory.
+    """
+    # TarFile keeps every member it has read in its members list,
+    # which uses a lot of memory with packages having hundreds of thousands of files
+    while True:
+        member = tar.next()
+        if member is None:
+            break
+        tar.members = []
+        yield member
 
 def readevx(filename, package):
     """Reads an eVox file and returns the data as a dictionary.
@@ -12,16 +22,20 @@ def readevx(filename, package):
 
     pkginfo_dict = {}
 
+    # The PKGINFO and PKGDEPS files, once we have found them in the archive
+    pkginfo = None
+    pkgdeps = None
+    pkgtree = None
+
     with open(filename, "rb") as f:
         # We create a decompressor object
         dctx = zstd.ZstdDecompressor()
         # We create a reader object
         reader = dctx.stream_reader(f)
-        # We need to write the data to a tar file
-        open("temp.tar", "w").close()
-        open("temp.tar", "wb").write(reader.read())
 
-        with tarfile.open("temp.tar", "r") as tar:
+        # We read the tar archive as a stream, straight from the decompressor,
+        # so nothing is written to the disk
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
             # The eVox archive has the following structure:
             # - metadata/
             #  - PKGINFO
@@ -43,31 +57,7 @@ def readevx(filename, package):
             # - url
             # - license
             # - maintainer
-            
-            # Extract the PKGINFO file
-            pkginfo = tar.extractfile(package + "/metadata/PKGINFO").read().decode("utf-8")
-            # Split the PKGINFO file into lines
-            pkginfo = pkginfo.splitlines()
-            # Create a dictionary to store the package infos
-            # Loop through the lines
-            for line in pkginfo:
-                # Split the line into key and value
-                key, value = line.split(" = ")
-                # Add the key and value to the dictionary
-                pkginfo_dict[key] = value
-
-            # We check that the needed fields are present
-            if "name" not in pkginfo_dict:
-                raise Exception("Package name not found in PKGINFO")
-            if "version" not in pkginfo_dict:
-                raise Exception("Package version not found in PKGINFO")
-            if "description" not in pkginfo_dict:
-                raise Exception("Package description not found in PKGINFO")
-            if "source" not in pkginfo_dict:
-                raise Exception("Package source not found in PKGINFO")
-            #if "pkgrel" not in pkginfo_dict:
-            #    raise Exception("Package release (pkgrel field) not found in PKGINFO")
-            
+
             # We need to extract the PKGDEPS file to get the package dependencies.
             # The PKGDEPS file has the following structure:
             # - <package name>
@@ -75,23 +65,66 @@ def readevx(filename, package):
             # - <package name>
             # - ...
 
-            # Note that the package dependencies are optional, so we need to check if the file exists.
-            if package + "/metadata/PKGDEPS" in tar.getnames():
-                # Extract the PKGDEPS file
-                pkgdeps = tar.extractfile(package + "/metadata/PKGDEPS").read().decode("utf-8")
-                # Split the PKGDEPS file into lines
-                pkgdeps = pkgdeps.splitlines()
-                # Create a list to store the package dependencies
-                pkgdeps_list = []
-                # Loop through the lines
-                for line in pkgdeps:
-                    # Add the line to the list
-                    pkgdeps_list.append(line)
-
-                # We add the package dependencies to the package infos dictionary
-                pkginfo_dict["depends"] = pkgdeps_list
-
-        # Delete the temp.tar file
-        os.remove("temp.tar")
-        # We return the package infos dictionary
-        return pkginfo_dict
\ No newline at end of file
+            # In a stream, the members can only be read in order, so we read them as they come.
+            # The packages are built with metadata/ first, so we stop reading the archive as soon
+            # as we leave the metadata/ directory, without decompressing the data at all.
+            # If the metadata comes after the data, we still find it, just later.
+            in_metadata = False
+            for member in iter_members(tar):
+                if member.name.startswith(package + "/metadata/"):
+                    in_metadata = True
+                elif in_metadata:
+                    break
+
+                if member.name == package + "/metadata/PKGINFO":
+                    pkginfo = tar.extractfile(member).read().decode("utf-8")
+                elif member.name == package + "/metadata/PKGDEPS":
+                    pkgdeps = tar.extractfile(member).read().decode("utf-8")
+                elif member.name == package + "/metadata/PKGTREE":
+                    pkgtree = tar.extractfile(member).read().decode("utf-8")
+
+    if pkginfo is None:
+        raise Exception("PKGINFO not found in package")
+
+    # Split the PKGINFO file into lines
+    pkginfo = pkginfo.splitlines()
+    # Create a dictionary to store the package infos
+    # Loop through the lines
+    for line in pkginfo:
+        # Split the line into key and value
+        key, value = line.split(" = ")
+        # Add the key and value to the dictionary
+        pkginfo_dict[key] = value
+
+    # We check that the needed fields are present
+    if "name" not in pkginfo_dict:
+        raise Exception("Package name not found in PKGINFO")
+    if "version" not in pkginfo_dict:
+        raise Exception("Package version not found in PKGINFO")
+    if "description" not in pkginfo_dict:
+        raise Exception("Package description not found in PKGINFO")
+    if "source" not in pkginfo_dict:
+        raise Exception("Package source not found in PKGINFO")
+    #if "pkgrel" not in pkginfo_dict:
+    #    raise Exception("Package release (pkgrel field) not found in PKGINFO")
+
+    # Note that the package dependencies are optional, so we need to check if the file exists.
+    if pkgdeps is not None:
+        # Split the PKGDEPS file into lines
+        pkgdeps = pkgdeps.splitlines()
+        # Create a list to store the package dependencies
+        pkgdeps_list = []
+        # Loop through the lines
+        for line in pkgdeps:
+            # Add the line to the list
+            pkgdeps_list.append(line)
+
+        # We add the package dependencies to the package infos dictionary
+        pkginfo_dict["depends"] = pkgdeps_list
+
+    # The PKGTREE file lists the files of the package, we use it to check the conflicts with other packages
+    if pkgtree is not None:
+        pkginfo_dict["tree"] = pkgtree.splitlines()
+
+    # We return the package infos dictionary
+    return pkginfo_dict
\ No newline at end of file
@@ -0,0 +1,162 @@
+# resolver computes the whole transaction of an install or an upgrade before anything is installed
+#
+# A transaction is a list of tuples (action, name, version, pkgrel, repo), sorted so that
+# each package comes after its dependencies. The action is one of:
+# - install: the package isn't installed yet
+# - upgrade: the package is installed and will be replaced by the version of the catalog
+# - skip: the package has been asked but is already installed
+
+import os
+
+import lib.cache as cache
+import lib.catalog as catalog
+import lib.config as config
+import lib.db as db
+import lib.log as log
+import lib.net as net
+import lib.readevx as readevx
+
+from lib.root import *
+
+def get_package_path(repo: str, name: str, version: str):
+    # Returns the path of a downloaded package: /var/evox/repos/<repo>/<name>-<version>.evx
+    return os.path.join(root, "var/evox/repos/" + repo) + "/" + name + "-" + version + ".evx"
+
+def get_package_url(repo: str, name: str, version: str):
+    # Returns the URL of a package in its repository
+    return config.get_config()[repo]["url"] + "/" + name + "-" + version + ".evx"
+
+def fetch(transaction: list):
+    # Download all the packages of a transaction that aren't downloaded yet, at the same time
+    # The packages that are in the cache are taken from it instead of being downloaded
+    # When the catalog knows the checksum of a package, the downloaded file is checked against it
+    # Returns the list of the files added to the repository directories
+    downloads = []
+    downloaded = []
+    for action, name, version, pkgrel, repo in transaction:
+        if action == "skip":
+            continue
+        path = get_package_path(repo, name, version)
+        if os.path.exists(path) or path in downloaded:
+            continue
+        downloaded.append(path)
+        pkg = catalog.lookup(name)
+        sha256 = pkg[5] if pkg is not None and pkg[2] == version else None
+        if not cache.get(name, version, pkgrel, path, sha256):
+            downloads.append((get_package_url(repo, name, version), path, sha256, name, version, pkgrel))
+
+    try:
+        net.download_many([(link, path, sha256) for link, path, sha256, name, version, pkgrel in downloads])
+    except Exception as e:
+        log.log_error(str(e))
+        exit(1)
+
+    # We add the new packages to the cache
+    for link, path, sha256, name, version, pkgrel in downloads:
+        cache.store(path, name, version, pkgrel, sha256)
+    if len(downloads) > 0:
+        cache.evict()
+
+    return downloaded
+
+def resolve(packages: list, upgrade: bool = False):
+    # Compute the transaction needed to install (or upgrade) the given packages and their missing dependencies
+    # If a package or a dependency isn't in the repositories, or if there is a dependency cycle,
+    # we log all the errors and exit before anything is installed
+    entries = {}
+    depends = {}
+    missing = []
+    skipped = []
+    # The packages downloaded to read their dependencies
+    fetched = []
+
+    # The packages that have been asked but are already installed are skipped,
+    # unless we are upgrading them
+    wave = []
+    for package in packages:
+        if not upgrade and db.is_installed(package):
+            if package not in skipped:
+                skipped.append(package)
+        else:
+            wave.append(package)
+
+    # We walk the dependencies level by level
+    while len(wave) > 0:
+        found = []
+        for package in wave:
+            if package in entries or package in missing:
+                continue
+
+            pkg = catalog.lookup(package)
+            if pkg is None:
+                missing.append(package)
+                continue
+
+            entries[package] = pkg
+            found.append(package)
+
+        # When the catalog doesn't know the dependencies of a package,
+        # we have to download it and read them from the package itself
+        unknown = [package for package in found if entries[package][4] is None]
+        fetched += fetch([("install", package, entries[package][2], entries[package][3], entries[package][1]) for package in unknown])
+
+        wave = []
+        for package in found:
+            if entries[package][4] is not None:
+                depends[package] = entries[package][4]
+            else:
+                pkginfo = readevx.readevx(get_package_path(entries[package][1], package, entries[package][2]), package)
+                depends[package] = pkginfo.get("depends", [])
+
+            # The installed dependencies don't need to be part of the transaction
+            for dep in depends[package]:
+                if dep not in entries and not db.is_installed(dep):
+                    wave.append(dep)
+
+    # We sort the packages so that each one comes after its dependencies
+    # The order only depends on the order of the packages and of their dependencies, so it's always the same
+    order = []
+    state = {}
+    cycles = []
+
+    def visit(package, path):
+        if state.get(package) == "done":
+            return
+        if state.get(package) == "visiting":
+            cycles.append(path[path.index(package):] + [package])
+            return
+
+        state[package] = "visiting"
+        for dep in depends[package]:
+            if dep in depends:
+                visit(dep, path + [package])
+        state[package] = "done"
+        order.append(package)
+
+    for package in depends:
+        visit(package, [])
+
+    # If something is wrong, we stop here
+    for package in missing:
+        log.log_error("Package " + package + " not found in repositories!")
+    for cycle in cycles:
+        log.log_error("Dependency cycle: " + " -> ".join(cycle))
+    if len(missing) > 0 or len(cycles) > 0:
+        # Nothing will be installed, so we don't keep the packages we have downloaded
+        for path in fetched:
+            if os.path.exists(path):
+                os.remove(path)
+        exit(1)
+
+    transaction = []
+    for package in skipped:
+        installed = db.get_local_package(package)
+        transaction.append(("skip", package, installed[1], db.get_local_package_pkgrel(package), None))
+    for package in order:
+        name, repo, version, pkgrel, deps, sha256 = entries[package]
+        if upgrade and db.is_installed(package):
+            transaction.append(("upgrade", name, version, pkgrel, repo))
+        else:
+            transaction.append(("install", name, version, pkgrel, repo))
+
+    return transaction
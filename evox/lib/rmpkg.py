@@ -2,47 +2,64 @@
 
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.root import *
 import lib.log as log
 import lib.db as db
+import lib.config as config
+import lib.pkgindex as pkgindex
+import lib.profile as profile
+import lib.triggers as triggers
 import lib.instpkg as instpkg
 
+def _remove(path: str):
+    # Remove a file or a link
+    # Returns the path if it's a directory, so it can be removed after its content
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except IsADirectoryError:
+        return path
+    return None
+
 def rmtree(pkgtree: list):
-    # For each line in the PKGTREE file
-    dirs_list = []
+    # Remove the files and the empty directories of a PKGTREE
+    # The paths that have other paths of the tree under them are directories, the other ones are removed
+    # as files, by several threads at the same time (REMOVE_JOBS in the config file, 8 by default)
+    paths = set()
+    parents = set()
     for line in pkgtree:
-        # We get the path to the file
-        path = os.path.join(root, line)
+        path = os.path.normpath(line.strip()).strip("/")
+        if path in ("", "."):
+            continue
+        paths.add(path)
+        parent = os.path.dirname(path)
+        while parent != "" and parent not in parents:
+            parents.add(parent)
+            parent = os.path.dirname(parent)
 
-        # If the file exists
-        if os.path.exists(path):
-            # We check if it's a directory
-            if os.path.isdir(path):
-                # If it is, we add it to the dirs_list
-                dirs_list.append(path)
-            else:
-                # If it isn't, we remove it
-                os.remove(path)
+    files = [os.path.join(root, path) for path in sorted(paths) if path not in parents]
+    dirs = [os.path.join(root, path) for path in paths if path in parents]
 
-        # We reverse the dirs_list
-    dirs_list.reverse()
+    jobs = int(config.get_option("REMOVE_JOBS", 8))
+    with profile.span("remove files"):
+        if jobs > 1 and len(files) > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(_remove, files))
+        else:
+            results = [_remove(path) for path in files]
+        dirs += [path for path in results if path is not None]
 
-    # We remove the directories only if they're empty
-    for d in dirs_list:
-        # If it is a link, check that it's not broken
-        if os.path.islink(d):
-            if not os.path.exists(os.path.join(os.path.dirname(d), os.readlink(d))):
-                os.remove(d)
-                continue
-        # We check if the directory is empty
-        if len(os.listdir(d)) == 0:
-            # If it is a link, we remove it by using os.remove
-            if os.path.islink(d):
-                os.remove(d)
-            else:
-                # If not, we remove the path as a directory
+        # We remove the deepest directories first, each one only if it's empty:
+        # rmdir fails on a directory that isn't empty (or on a link to a directory, like /lib in a merged /usr)
+        for d in sorted(dirs, reverse=True):
+            try:
                 os.rmdir(d)
+            except OSError:
+                pass
+    profile.count("files removed", results.count(None))
 
 
 def rmpkg(package: str, with_deps: bool = True):
@@ -55,35 +72,37 @@ def rmpkg(package: str, with_deps: bool = True):
     # We get the path to the package directory
     pkgdir = root + "/var/evox/packages/" + package
 
-    # We check if the package has dependencies by reading the PKGDEPS file
+    # We check if the package has dependencies (its PKGDEPS, from the metadata store)
     # Note: The PKGDEPS file is optional
-    if with_deps and os.path.exists(pkgdir + "/PKGDEPS"):
-        # If it exists, we read it
-        with open(pkgdir + "/PKGDEPS", "r") as f:
-            deps = f.read().splitlines()
-            # For each dependency
-            for dep in deps:
-                # We check if the package is installed
-                if instpkg.is_package_installed(dep):
-                    # We check if the package is a dependency of another package
-                    if not db.is_package_dependency(dep, package):
-                        # Log an info message
-                        log.log_info("Removing dependency " + dep)
-                        # If it isn't, we remove it
-                        rmpkg(dep)
-                        # We log a success message
-                        log.log_success("Removed dependency " + dep)
-                        print()
-                    else:
-                        # Log an info message
-                        log.log_info(
-                            "Package " + dep + " is a dependency of another package, not removing it")
+    if with_deps:
+        # For each dependency
+        for dep in db.get_local_package_pkgdeps(package):
+            # We check if the package is installed
+            if instpkg.is_package_installed(dep):
+                # We check if the package is a dependency of another package
+                if not db.is_package_dependency(dep, package):
+                    # Log an info message
+                    log.log_info("Removing dependency " + dep)
+                    # If it isn't, we remove it
+                    rmpkg(dep)
+                    # We log a success message
+                    log.log_success("Removed dependency " + dep)
+                    print()
+                else:
+                    # Log an info message
+                    log.log_info(
+                        "Package " + dep + " is a dependency of another package, not removing it")
 
-    # We get the PKGTREE file
-    rmtree(open(pkgdir + "/PKGTREE", "r").read().splitlines())
+    # We get the PKGTREE, without the files that are also owned by other packages
+    shared_files = pkgindex.get_shared_files(package)
+    tree = [path for path in db.get_local_package_pkgtree(package) if pkgindex.normalize(path) not in shared_files]
+    rmtree(tree)
+    # Removing a library also needs ldconfig, at the end of the transaction
+    triggers.queue_paths(tree)
 
     # We remove the package directory
     shutil.rmtree(pkgdir)
 
     # We remove the package from the DB
     db.unregister_local(package)
+    pkgindex.remove_package(package)
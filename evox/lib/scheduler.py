@@ -0,0 +1,35 @@
+# scheduler decides how the packages of a transaction are unpacked
+#
+# With one job, each package is staged and committed when it's installed.
+# With several jobs, the packages are decompressed and staged by a pool of processes,
+# ahead of their installation, while the main process commits them to the root
+# in the order of the transaction, so each package is still installed after its dependencies.
+
+from concurrent.futures import ProcessPoolExecutor
+
+import lib.addpkg as addpkg
+import lib.profile as profile
+import lib.resolver as resolver
+
+def schedule(transaction: list, jobs: int = 1):
+    # Yields a tuple (entry, stagedir) for each package to install or upgrade, in the order of the transaction
+    # stagedir is the directory where the package has been staged by addpkg.stagepkg,
+    # or None if the package must be staged when it's installed
+    # The packages of the transaction must have been downloaded
+    actions = [entry for entry in transaction if entry[0] != "skip"]
+
+    if jobs <= 1 or len(actions) <= 1:
+        for entry in actions:
+            yield entry, None
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for action, name, version, pkgrel, repo in actions:
+            futures.append(executor.submit(addpkg.stagepkg, resolver.get_package_path(repo, name, version), name))
+
+        # We commit the packages in order, while the next ones are still being staged
+        for entry, future in zip(actions, futures):
+            with profile.span("wait for staging"):
+                stagedir = future.result()
+            yield entry, stagedir
@@ -0,0 +1,128 @@
+# search module finds packages in the catalog by their name or their description
+#
+# There are three modes:
+# - substring (default): the expression is in the name, or each of its words starts a word of the description,
+#   ignoring the case. The candidates are found with the indexes of the catalog, without reading every package
+# - regex: the expression is a regular expression, searched in the name and in the description
+# - fuzzy: the characters of the expression are in the name, in the same order (but not
+#   necessarily next to each other, "gcc" matches "gcc-libs" and "gnu-c-compiler")
+#
+# The results are ranked: an exact name first, then the names starting with the expression,
+# the names containing it, and the descriptions matching it. With the fuzzy mode, the names
+# where the characters are the closest to each other come first.
+
+import re
+
+import lib.catalog as catalog
+import lib.db as db
+import lib.log as log
+import lib.pkgindex as pkgindex
+
+def _candidates(expr: str):
+    # Returns the rows (name, version, pkgrel, description) of the packages that may match expr:
+    # the names having all the trigrams of expr, and the descriptions having, for each word of expr,
+    # a word starting with it
+    trigrams = list(catalog.trigrams(expr))
+    if len(trigrams) > 0:
+        names = "name IN (SELECT name FROM trigrams WHERE trigram IN (" + ", ".join("?" * len(trigrams)) + ") GROUP BY name HAVING COUNT(*) = ?)"
+        params = trigrams + [len(trigrams)]
+    else:
+        # The expression is too short for the index, but comparing it to every name is fast enough
+        names = "instr(lower(name), ?) > 0"
+        params = [expr.lower()]
+
+    words = sorted(catalog.words(expr))
+    if len(words) > 0:
+        # The words starting with a prefix are the ones between the prefix and the prefix with its last character incremented
+        descriptions = " AND ".join("name IN (SELECT name FROM words WHERE word >= ? AND word < ?)" for word in words)
+        for word in words:
+            params += [word, word[:-1] + chr(ord(word[-1]) + 1)]
+        condition = "(" + names + ") OR (" + descriptions + ")"
+    else:
+        condition = names
+
+    return catalog.open_catalog().execute("SELECT name, version, pkgrel, description FROM packages WHERE " + condition, params).fetchall()
+
+def _rank(expr: str, prefixes: set, name: str, description: str):
+    # Returns the rank of a package for a substring search, or None if it doesn't match
+    # expr must be in lower case, prefixes are the words of expr
+    name = name.lower()
+    if name == expr:
+        return 0
+    if name.startswith(expr):
+        return 1
+    if expr in name:
+        return 2
+    if description is not None and len(prefixes) > 0:
+        description_words = catalog.words(description)
+        if all(any(word.startswith(prefix) for word in description_words) for prefix in prefixes):
+            return 3
+    return None
+
+def _rank_regex(regex, name: str, description: str):
+    # Returns the rank of a package for a regex search, or None if it doesn't match
+    if regex.fullmatch(name):
+        return 0
+    if regex.match(name):
+        return 1
+    if regex.search(name):
+        return 2
+    if description is not None and regex.search(description):
+        return 3
+    return None
+
+def _rank_fuzzy(expr: str, name: str):
+    # Returns the rank of a package for a fuzzy search (the number of characters between
+    # the characters of expr in the name), or None if it doesn't match
+    expr = expr.lower()
+    name = name.lower()
+    position = name.find(expr[0]) if len(expr) > 0 else 0
+    if position < 0:
+        return None
+    start = position
+    for char in expr[1:]:
+        position = name.find(char, position + 1)
+        if position < 0:
+            return None
+    return (position - start + 1) - len(expr)
+
+def search(expr: str, mode: str = "substring"):
+    # Search the packages of the catalog
+    # mode is one of substring, regex and fuzzy
+    # Returns a list of tuples (name, version, pkgrel, description, installed version, installed pkgrel), best first
+    # The installed version and pkgrel are None if the package isn't installed
+    if mode == "regex":
+        try:
+            regex = re.compile(expr, re.IGNORECASE)
+        except re.error as e:
+            log.log_error("Invalid regular expression " + expr + ": " + str(e))
+            exit(1)
+        rows = catalog.open_catalog().execute("SELECT name, version, pkgrel, description FROM packages").fetchall()
+        rank = lambda name, description: _rank_regex(regex, name, description)
+    elif mode == "fuzzy":
+        rows = catalog.open_catalog().execute("SELECT name, version, pkgrel, description FROM packages").fetchall()
+        rank = lambda name, description: _rank_fuzzy(expr, name)
+    else:
+        rows = _candidates(expr)
+        prefixes = catalog.words(expr)
+        rank = lambda name, description: _rank(expr.lower(), prefixes, name, description)
+
+    results = []
+    for name, version, pkgrel, description in rows:
+        package_rank = rank(name, description)
+        if package_rank is not None:
+            results.append((package_rank, len(name), name, version, pkgrel, description))
+    results.sort()
+
+    # The installed packages come from the local DB, which is already in memory,
+    # and their pkgrel from the metadata store, read once
+    installed = db.get_installed_packages()
+    infos = pkgindex.get_all_info() if len(results) > 0 and len(installed) > 0 else {}
+
+    packages = []
+    for package_rank, length, name, version, pkgrel, description in results:
+        if name in installed:
+            packages.append((name, version, pkgrel, description, installed[name], infos.get(name, {}).get("pkgrel")))
+        else:
+            packages.append((name, version, pkgrel, description, None, None))
+    return packages
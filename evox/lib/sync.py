@@ -0,0 +1,185 @@
+# sync module updates the INDEX files of the repositories
+#
+# Next to its INDEX, a repository can publish:
+# - INDEX.sha256: the SHA-256 checksum of the INDEX
+# - INDEX.zst: the INDEX compressed with zstd
+# - INDEX.d/<checksum>: a delta from the INDEX having this checksum to the current one, with lines like:
+#   + <package name> <version> <pkgrel> [<field>=<value> ...]  (a package added or updated)
+#   - <package name>                                           (a package removed)
+# All of them are optional. The files are fetched with conditional requests (ETag and
+# Last-Modified), so syncing an unchanged repository only costs one small request.
+#
+# What we know about the last sync of a repository is kept in /var/evox/repos/<repo>/INDEX.state
+
+import os
+import json
+import shutil
+import hashlib
+import zstandard
+from urllib import error
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.net as net
+import lib.config as config
+
+from lib.root import *
+
+def read_state(repo: str):
+    # Returns the state of the last sync of a repository
+    path = root + "/var/evox/repos/" + repo + "/INDEX.state"
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def write_state(repo: str, state: dict):
+    path = root + "/var/evox/repos/" + repo + "/INDEX.state"
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+def write_index(repo: str, data: bytes):
+    # Replace the INDEX of a repository
+    path = root + "/var/evox/repos/" + repo + "/INDEX"
+    with open(path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(path + ".tmp", path)
+
+def checksum(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+def fetch(link: str, cache: dict):
+    # Download a file of a repository, unless it hasn't changed since the last sync
+    # cache holds the ETag and Last-Modified date we got for this file, it's updated in place
+    # Returns the content of the file, None if it hasn't changed,
+    # or False if the repository doesn't publish this file
+    headers = {}
+    if "etag" in cache:
+        headers["If-None-Match"] = cache["etag"]
+    if "last_modified" in cache:
+        headers["If-Modified-Since"] = cache["last_modified"]
+
+    try:
+        response = net.open_url(link, headers=headers)
+    except error.HTTPError as e:
+        if e.code == 404:
+            return False
+        raise
+
+    if getattr(response, "status", 200) == 304:
+        response.read()
+        return None
+
+    data = response.read()
+
+    cache.clear()
+    if response.info().get("ETag") is not None:
+        cache["etag"] = response.info().get("ETag")
+    if response.info().get("Last-Modified") is not None:
+        cache["last_modified"] = response.info().get("Last-Modified")
+
+    return data
+
+def apply_delta(index: bytes, delta: bytes):
+    # Apply a delta to an INDEX and returns the new INDEX
+    packages = {}
+    for line in index.decode("utf-8").splitlines():
+        if line.strip() != "":
+            packages[line.split()[0]] = line
+
+    for line in delta.decode("utf-8").splitlines():
+        if line.startswith("+ "):
+            packages[line[2:].split()[0]] = line[2:]
+        elif line.startswith("- "):
+            packages.pop(line[2:].strip(), None)
+
+    return ("\n".join(packages.values()) + "\n").encode("utf-8")
+
+def sync_local(repo: str, url: str):
+    # Sync a repository which is a local directory
+    # We copy its INDEX only if its size or its modification date have changed
+    state = read_state(repo)
+    stat = os.stat(url + "/INDEX")
+    if state.get("size") == stat.st_size and state.get("mtime") == stat.st_mtime and os.path.isfile(root + "/var/evox/repos/" + repo + "/INDEX"):
+        return False
+
+    shutil.copyfile(url + "/INDEX", root + "/var/evox/repos/" + repo + "/INDEX")
+    write_state(repo, {"size": stat.st_size, "mtime": stat.st_mtime})
+    return True
+
+def sync_repo(repo: str, url: str):
+    # Sync the INDEX of a repository
+    # Returns True if the INDEX has changed
+    path = root + "/var/evox/repos/" + repo
+    os.makedirs(path, exist_ok=True)
+
+    if os.path.exists(url):
+        return sync_local(repo, url)
+
+    state = read_state(repo)
+    cache = state.setdefault("cache", {})
+
+    index = None
+    if os.path.isfile(path + "/INDEX"):
+        with open(path + "/INDEX", "rb") as f:
+            index = f.read()
+
+    # If the repository publishes the checksum of its INDEX, we first check if it has changed
+    remote_checksum = fetch(url + "/INDEX.sha256", cache.setdefault("INDEX.sha256", {}))
+    if remote_checksum is None and index is not None:
+        return False
+    if remote_checksum:
+        remote_checksum = remote_checksum.decode("utf-8").split()[0]
+        if index is not None and checksum(index) == remote_checksum:
+            write_state(repo, state)
+            return False
+
+        # Then we try to get a delta from our INDEX to the new one
+        if index is not None:
+            delta = fetch(url + "/INDEX.d/" + checksum(index), {})
+            if delta:
+                new_index = apply_delta(index, delta)
+                if checksum(new_index) == remote_checksum:
+                    write_index(repo, new_index)
+                    write_state(repo, state)
+                    return True
+
+    # Else we download the whole INDEX, compressed if the repository has it
+    new_index = None
+    if state.get("compressed", True):
+        new_index = fetch(url + "/INDEX.zst", cache.setdefault("INDEX.zst", {}))
+        if new_index is False:
+            # We won't ask again for a compressed INDEX
+            state["compressed"] = False
+        elif new_index is not None:
+            new_index = zstandard.ZstdDecompressor().decompressobj().decompress(new_index)
+
+    if not state.get("compressed", True):
+        new_index = fetch(url + "/INDEX", cache.setdefault("INDEX", {}))
+        if new_index is False:
+            raise Exception("Repository " + repo + " has no INDEX")
+
+    # If the INDEX hasn't changed since the last sync, we keep ours
+    if new_index is None and index is not None:
+        write_state(repo, state)
+        return False
+    if new_index is None:
+        # We don't have the INDEX anymore, so we need to download it without condition
+        state["cache"] = {}
+        write_state(repo, state)
+        return sync_repo(repo, url)
+
+    if remote_checksum and checksum(new_index) != remote_checksum:
+        raise Exception("The INDEX of the repository " + repo + " doesn't match its checksum")
+
+    write_index(repo, new_index)
+    write_state(repo, state)
+    return index != new_index
+
+def sync_repos(repos: dict):
+    # Sync all the repositories at the same time
+    # Returns a dictionary telling for each repository if its INDEX has changed
+    jobs = int(config.get_option("PARALLEL_DOWNLOADS", 4))
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {repo: executor.submit(sync_repo, repo, repos[repo]["url"]) for repo in repos}
+        return {repo: futures[repo].result() for repo in futures}
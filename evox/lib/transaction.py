@@ -0,0 +1,178 @@
+# transaction module installs a package so that evox can be killed at any time without breaking the system
+#
+# A package is first extracted to a staging directory (/var/evox/staging/<package>-XXXX, see addpkg.stagepkg),
+# which doesn't touch the installed files. Then it's committed, step by step:
+# 1. we write the journal of the commit (/var/evox/staging/<package>-XXXX.journal) and sync it to the disk
+# 2. the files are moved from the staging directory to the root, with renames
+# 3. the metadata of the installed version (if any) is moved to /var/evox/packages/<package>.old,
+#    and the new metadata is moved to /var/evox/packages/<package>
+# 4. the package is registered in the local DB and in the indexes
+# 5. the files of the old version that aren't in the new one (and aren't owned by another package) are removed
+# 6. the staging directory, the old metadata and the journal are removed
+#
+# Before the journal is written, we check that the files can be moved (a directory of the package
+# can't replace a file of the root), so a commit that has begun can be finished.
+#
+# Each step can be run again once it has been done, so when evox starts after being killed (see recover):
+# - a staging directory with a journal has begun its commit: we roll it forward by running the commit again
+#   (if it fails again, we undo what we can, see abort)
+# - a staging directory without a journal hasn't: we roll it back by removing it
+#
+# The journal has the following format:
+# package <name>
+# version <version>
+
+import os
+import shutil
+
+import lib.addpkg as addpkg
+import lib.db as db
+import lib.log as log
+import lib.pkgindex as pkgindex
+import lib.profile as profile
+import lib.rmpkg as rmpkg
+import lib.upgrade as upgrade
+
+from lib.root import *
+
+STAGING = os.path.join(root, "var/evox/staging")
+
+def write_journal(stagedir: str, package: str, version: str):
+    # Write the journal of a commit and sync it to the disk
+    # We write a temporary file and rename it, so the journal is either complete or missing
+    journal = stagedir + ".journal"
+    with open(journal + ".tmp", "w") as f:
+        f.write("package " + package + "\n")
+        f.write("version " + version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(journal + ".tmp", journal)
+
+def read_journal(stagedir: str):
+    # Read the journal of a commit
+    # Returns a tuple (package, version)
+    fields = {}
+    with open(stagedir + ".journal", "r") as f:
+        for line in f:
+            key, _, value = line.strip().partition(" ")
+            fields[key] = value
+    return fields["package"], fields["version"]
+
+def commit(stagedir: str, package: str, version: str):
+    # Commit a staged package to the root
+    # Returns a tuple of lists (added, replaced, removed) of the files added, replaced by the new version,
+    # and removed because the new version doesn't have them (see upgrade.diff_trees)
+    pkgdir = os.path.join(root, "var/evox/packages", package)
+
+    if not os.path.isfile(stagedir + ".journal"):
+        # Once the journal is written, the commit must be able to finish
+        obstacles = addpkg.find_obstacles(os.path.join(stagedir, "data"), root) if os.path.isdir(os.path.join(stagedir, "data")) else []
+        if len(obstacles) > 0:
+            for path in obstacles:
+                log.log_error("Can't install " + package + ": " + path + " is in the way (a file where a directory is needed, or the opposite)!")
+            rollback(stagedir)
+            exit(1)
+        write_journal(stagedir, package, version)
+
+    # The files that have already been moved aren't in the staging directory anymore,
+    # so we only move the remaining ones
+    if os.path.isdir(os.path.join(stagedir, "data")):
+        with profile.span("place", package):
+            addpkg.place(os.path.join(stagedir, "data"), root)
+
+    # We keep the metadata of the installed version until the end, we need its PKGTREE
+    if os.path.isdir(os.path.join(stagedir, "metadata")):
+        if os.path.isdir(pkgdir) and not os.path.isdir(pkgdir + ".old"):
+            os.rename(pkgdir, pkgdir + ".old")
+        os.makedirs(os.path.dirname(pkgdir), exist_ok=True)
+        if os.path.isdir(pkgdir):
+            shutil.rmtree(pkgdir)
+        os.rename(os.path.join(stagedir, "metadata"), pkgdir)
+
+    if os.path.isdir(os.path.join(stagedir, "scripts")):
+        if os.path.isdir(os.path.join(pkgdir, "scripts")):
+            shutil.rmtree(os.path.join(pkgdir, "scripts"))
+        os.rename(os.path.join(stagedir, "scripts"), os.path.join(pkgdir, "scripts"))
+
+    with profile.span("register", package):
+        addpkg.register(package, {"version": version})
+
+    # We remove the files of the old version that the new version doesn't have
+    added, replaced, removed = upgrade.read_tree(pkgdir + "/PKGTREE"), [], []
+    if os.path.isdir(pkgdir + ".old"):
+        added, replaced, removed = upgrade.diff_trees(upgrade.read_tree(pkgdir + ".old/PKGTREE"), added)
+        # The files owned by another package are kept
+        removed = [file for file in removed if len(pkgindex.get_owners(file)) == 0]
+        with profile.span("remove old files", package):
+            rmpkg.rmtree(removed)
+        shutil.rmtree(pkgdir + ".old")
+
+    shutil.rmtree(stagedir)
+    os.remove(stagedir + ".journal")
+    return added, replaced, removed
+
+def rollback(stagedir: str):
+    # Forget a staged package that hasn't been committed
+    if os.path.isdir(stagedir):
+        shutil.rmtree(stagedir)
+    if os.path.isfile(stagedir + ".journal"):
+        os.remove(stagedir + ".journal")
+
+def abort(stagedir: str, package: str):
+    # Undo what can be undone of a commit that can't be finished
+    # The files already moved to the root that the previous version didn't have are removed,
+    # and the metadata of the previous version (<package>.old) is put back and registered again,
+    # or, if the package wasn't installed, the package is forgotten
+    # The files of the previous version that have already been replaced can't be restored
+    pkgdir = os.path.join(root, "var/evox/packages", package)
+
+    # The files that have been moved are the ones of the new PKGTREE that aren't in the staging directory anymore
+    if os.path.isdir(os.path.join(stagedir, "metadata")):
+        tree = upgrade.read_tree(os.path.join(stagedir, "metadata", "PKGTREE"))
+    else:
+        tree = upgrade.read_tree(os.path.join(pkgdir, "PKGTREE"))
+    moved = [path for path in map(pkgindex.normalize, tree) if path != "" and not os.path.lexists(os.path.join(stagedir, "data", path))]
+
+    if os.path.isdir(pkgdir + ".old"):
+        if os.path.isdir(pkgdir):
+            shutil.rmtree(pkgdir)
+        os.rename(pkgdir + ".old", pkgdir)
+        old_version = db.read_local_package_info(package).get("version")
+        if old_version is not None:
+            addpkg.register(package, {"version": old_version})
+        old_tree = set(map(pkgindex.normalize, upgrade.read_tree(os.path.join(pkgdir, "PKGTREE"))))
+        moved = [path for path in moved if path not in old_tree]
+        log.log_warn("Some files of " + package + " may come from the new version, you should reinstall it.")
+    else:
+        if db.is_installed(package):
+            db.unregister_local(package)
+            pkgindex.remove_package(package)
+        if os.path.isdir(pkgdir) and not os.path.isdir(os.path.join(stagedir, "metadata")):
+            shutil.rmtree(pkgdir)
+
+    rmpkg.rmtree([path for path in moved if len(pkgindex.get_owners(path)) == 0])
+    rollback(stagedir)
+
+def recover():
+    # Finish or undo the transactions of an evox that has been killed
+    if not os.path.isdir(STAGING):
+        return
+
+    for name in sorted(os.listdir(STAGING)):
+        stagedir = os.path.join(STAGING, name)
+        if name.endswith(".journal.tmp"):
+            os.remove(stagedir)
+        elif name.endswith(".journal"):
+            stagedir = stagedir[:-len(".journal")]
+            package, version = read_journal(stagedir)
+            log.log_info("Finishing the interrupted installation of " + package + "-" + version + "...")
+            os.makedirs(stagedir, exist_ok=True)
+            try:
+                commit(stagedir, package, version)
+            except Exception as e:
+                # We don't stay stuck on a commit that can't be finished
+                log.log_error("The installation of " + package + "-" + version + " can't be finished: " + str(e))
+                log.log_info("Undoing the installation of " + package + "-" + version + "...")
+                abort(stagedir, package)
+        elif os.path.isdir(stagedir) and not os.path.isfile(stagedir + ".journal"):
+            rollback(stagedir)
@@ -0,0 +1,75 @@
+# tree module builds the dependency graph of the installed packages for `evox tree`
+#
+# The graph is built once from the reverse dependency index, as a dictionary:
+# <package> -> [<dependencies>] (or [<packages depending on it>] for the reverse graph)
+# Each package is expanded only once, so shared dependencies and cycles don't make it blow up.
+
+import json
+from collections import deque
+
+import lib.pkgindex as pkgindex
+
+def build_graph(reverse: bool = False):
+    # Build the dependency graph of the installed packages
+    # If reverse is True, each package points to the packages depending on it
+    graph = {}
+    for dependency, package in pkgindex.get_all_depends():
+        if reverse:
+            graph.setdefault(dependency, []).append(package)
+        else:
+            graph.setdefault(package, []).append(dependency)
+    return graph
+
+def subgraph(graph: dict, package: str, depth: int = None):
+    # Returns the part of the graph reachable from a package, with the same format
+    # If depth is set, the packages deeper than depth levels aren't expanded
+    # We walk the graph breadth first, so each package is expanded at its lowest level
+    result = {}
+    levels = {package: 0}
+    queue = deque([package])
+    while len(queue) > 0:
+        name = queue.popleft()
+        if depth is None or levels[name] < depth:
+            result[name] = graph.get(name, [])
+        else:
+            result[name] = []
+
+        for child in result[name]:
+            if child not in levels:
+                levels[child] = levels[name] + 1
+                queue.append(child)
+    return result
+
+def format_text(graph: dict, package: str):
+    # Returns the lines of the tree of a package, each package is printed only once
+    lines = [package]
+    printed = set([package])
+    stack = [(child, 1) for child in reversed(graph.get(package, []))]
+    while len(stack) > 0:
+        name, level = stack.pop()
+        if name in printed:
+            continue
+        printed.add(name)
+
+        lines.append("--" * level + ">" + name)
+        for child in reversed(graph.get(name, [])):
+            stack.append((child, level + 1))
+    return lines
+
+def format_json(graph: dict, package: str, reverse: bool = False):
+    # Returns the graph of a package as JSON
+    return json.dumps({"package": package, "reverse": reverse, "graph": graph}, indent=2)
+
+def format_dot(graph: dict, package: str, reverse: bool = False):
+    # Returns the graph of a package in the DOT format of Graphviz
+    # The edges always go from a package to its dependency
+    lines = ['digraph "' + package + '" {']
+    for name in graph:
+        lines.append('    "' + name + '";')
+        for child in graph[name]:
+            if reverse:
+                lines.append('    "' + child + '" -> "' + name + '";')
+            else:
+                lines.append('    "' + name + '" -> "' + child + '";')
+    lines.append("}")
+    return "\n".join(lines)
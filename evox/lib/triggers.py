@@ -0,0 +1,199 @@
+# triggers module runs what needs to be run after the installation of packages, once per transaction
+#
+# Some programs have to be run when some kinds of files are installed or removed: ldconfig for the shared
+# libraries, gtk-update-icon-cache for the icons, fc-cache for the fonts...
+# Instead of running them after each package, the packages queue their triggers, and run
+# runs each trigger once, at the end of the transaction (evox get, remove and upgrade run it when they end).
+#
+# The triggers of a package are found from its PKGTREE (see TRIGGERS), and a package can also
+# declare them in its PKGINFO, separated by commas:
+# triggers = ldconfig, icon-cache:hicolor
+# (the argument after the colon is the one the trigger would have found in the path, like the icon theme)
+#
+# The post-install scripts (PKGPOST) are queued too, and run after the triggers.
+# The triggers don't depend on each other, so they are run at the same time (TRIGGER_JOBS in the config file,
+# 4 by default). The scripts are run one at a time, in the order of the transaction: two scripts can write
+# the same files (useradd, /etc/shells, install-info...) and ask something to the user. With PKGPOST_JOBS
+# in the config file, the scripts of packages that don't depend on each other are run at the same time,
+# each one after the scripts of its dependencies, without any input.
+#
+# Like before, nothing is run when the root isn't / (when we are installing to a chroot).
+
+import os
+import re
+import glob
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import lib.config as config
+import lib.log as log
+import lib.pkgindex as pkgindex
+import lib.profile as profile
+
+from lib.root import *
+
+# name: (regex matching the paths of a PKGTREE, command)
+# When the regex has a group, the trigger is run once for each value of the group, given to the command as {}
+TRIGGERS = {
+    "ldconfig": (re.compile(r"^(?:usr/)?(?:local/)?lib(?:32|64|x32)?/(?:.*/)?[^/]+\.so(?:\.[^/]*)?$|^etc/ld\.so\.conf"), ["/sbin/ldconfig"]),
+    "icon-cache": (re.compile(r"^usr/share/icons/([^/]+)/."), ["gtk-update-icon-cache", "-q", "-t", "-f", "/usr/share/icons/{}"]),
+    "font-cache": (re.compile(r"^usr/share/fonts/."), ["fc-cache", "-s"]),
+    "mime-database": (re.compile(r"^usr/share/mime/packages/."), ["update-mime-database", "/usr/share/mime"]),
+    "desktop-database": (re.compile(r"^usr/share/applications/[^/]+\.desktop$"), ["update-desktop-database", "-q", "/usr/share/applications"]),
+    "glib-schemas": (re.compile(r"^usr/share/glib-2\.0/schemas/[^/]+\.xml$"), ["glib-compile-schemas", "/usr/share/glib-2.0/schemas"])
+}
+
+# A shared library, in any directory
+LIBRARY = re.compile(r"[^/]\.so(?:\.[^/]*)?$")
+
+# The directories of the libraries given to ldconfig by /etc/ld.so.conf (read once)
+_library_dirs = None
+
+# The triggers to run, as tuples (name, argument)
+_triggers = set()
+# The packages whose PKGPOST must be run, in the order they have been installed
+_hooks = []
+
+def get_library_dirs():
+    # Returns the directories of /etc/ld.so.conf and of the files it includes (like /etc/ld.so.conf.d/*.conf),
+    # relative to the root, each one ending with a slash
+    global _library_dirs
+    if _library_dirs is not None:
+        return _library_dirs
+
+    _library_dirs = []
+    files = [os.path.join(root, "etc/ld.so.conf")]
+    read = set()
+    while len(files) > 0:
+        path = files.pop(0)
+        if path in read or not os.path.isfile(path):
+            continue
+        read.add(path)
+        with open(path, "r") as f:
+            for line in f:
+                line = line.split("#")[0].strip()
+                if line.startswith("include "):
+                    pattern = line[len("include "):].strip()
+                    if not pattern.startswith("/"):
+                        pattern = os.path.join(os.path.dirname(path), pattern)
+                    else:
+                        pattern = os.path.join(root, pattern.lstrip("/"))
+                    files += sorted(glob.glob(pattern))
+                elif line != "":
+                    _library_dirs.append(line.strip("/") + "/")
+    return _library_dirs
+
+def detect(paths: list):
+    # Returns the set of the triggers (name, argument) of the paths of a PKGTREE
+    triggers = set()
+    for line in paths:
+        path = line.strip().strip("/")
+        for name, (regex, command) in TRIGGERS.items():
+            match = regex.match(path)
+            if match is not None:
+                triggers.add((name, match.group(1) if regex.groups > 0 else None))
+        # The libraries of the directories added to /etc/ld.so.conf also need ldconfig
+        if LIBRARY.search(path) and any(path.startswith(directory) for directory in get_library_dirs()):
+            triggers.add(("ldconfig", None))
+    return triggers
+
+def declared(info: dict):
+    # Returns the set of the triggers (name, argument) declared in a PKGINFO
+    triggers = set()
+    for value in info.get("triggers", "").split(","):
+        name, _, argument = value.strip().partition(":")
+        if name == "":
+            continue
+        if name not in TRIGGERS:
+            log.log_warn("Unknown trigger " + name + ", ignoring it.")
+            continue
+        triggers.add((name, argument if argument != "" else None))
+    return triggers
+
+def queue_paths(paths: list):
+    # Queue the triggers of installed or removed paths
+    _triggers.update(detect(paths))
+
+def queue(package: str, info: dict, paths: list):
+    # Queue the triggers and the post-install script of an installed package
+    _triggers.update(detect(paths))
+    _triggers.update(declared(info))
+    if os.path.exists(os.path.join(root, "var/evox/packages", package, "scripts", "PKGPOST")) and package not in _hooks:
+        _hooks.append(package)
+
+def _command(name: str, argument: str):
+    # Returns the command of a trigger, or None if it can't be run
+    command = [part.replace("{}", argument) if argument is not None else part for part in TRIGGERS[name][1]]
+    if any("{}" in part for part in command):
+        log.log_warn("The trigger " + name + " needs an argument, ignoring it.")
+        return None
+    # The program isn't installed: there is nothing to update
+    if shutil.which(command[0]) is None:
+        return None
+    return command
+
+def _run_trigger(name: str, argument: str):
+    command = _command(name, argument)
+    if command is None:
+        return
+    with profile.span(name):
+        if subprocess.run(command, cwd=root).returncode != 0:
+            log.log_warn("The trigger " + " ".join(command) + " has failed.")
+
+def _run_hook(package: str, parallel: bool = False):
+    # The scripts run at the same time can't share the input
+    stdin = subprocess.DEVNULL if parallel else None
+    with profile.span("PKGPOST", package):
+        if subprocess.run(["bash", os.path.join(root, "var/evox/packages", package, "scripts", "PKGPOST")], cwd=root, stdin=stdin).returncode != 0:
+            log.log_warn("The post-install script of " + package + " has failed.")
+
+def _waves(packages: list):
+    # Split the packages in waves: each package is in a wave after the waves of its dependencies
+    # Returns a list of lists of packages
+    # A package can depend on a script through packages without scripts (A -> B -> C), so we look at
+    # all the dependencies of each package, not only the direct ones
+    closures = {}
+    def closure(package):
+        if package not in closures:
+            closures[package] = set()
+            stack = [package]
+            while len(stack) > 0:
+                for dep in pkgindex.get_depends(stack.pop()):
+                    if dep not in closures[package] and dep != package:
+                        closures[package].add(dep)
+                        stack.append(dep)
+        return closures[package]
+
+    level = {}
+    for package in packages:
+        # The packages are in the order of the transaction, so the dependencies come first
+        level[package] = 1 + max([level[dep] for dep in closure(package) if dep in level], default=-1)
+    waves = [[] for n in range(max(level.values(), default=-1) + 1)]
+    for package in packages:
+        waves[level[package]].append(package)
+    return waves
+
+def run():
+    # Run the queued triggers and post-install scripts, and empty the queue
+    global _hooks
+    triggers = sorted(_triggers, key=lambda trigger: (trigger[0], trigger[1] or ""))
+    hooks = _hooks
+    _triggers.clear()
+    _hooks = []
+
+    if root != "/" or (len(triggers) == 0 and len(hooks) == 0):
+        return
+
+    jobs = int(config.get_option("TRIGGER_JOBS", 4))
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        list(executor.map(lambda trigger: _run_trigger(*trigger), triggers))
+
+    jobs = int(config.get_option("PKGPOST_JOBS", 1))
+    if jobs <= 1:
+        for package in hooks:
+            _run_hook(package)
+        return
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for wave in _waves(hooks):
+            list(executor.map(lambda package: _run_hook(package, True), wave))
@@ -0,0 +1,100 @@
+# upgrade module finds the outdated packages and replaces them by their new version
+
+import os
+import re
+
+import lib.catalog as catalog
+import lib.db as db
+import lib.instpkg as instpkg
+import lib.log as log
+import lib.pkgindex as pkgindex
+
+from lib.root import *
+
+def read_tree(path: str):
+    # Read a PKGTREE file and returns the list of its files
+    tree = []
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            for line in f:
+                tree.append(line.strip())
+    return tree
+
+def diff_trees(old_tree: list, new_tree: list):
+    # Compare the files of the old and the new version of a package
+    # Returns a tuple of lists (added, replaced, removed), each one in the order of its tree:
+    # - added: the files that are only in the new version
+    # - replaced: the files that are in both versions, they are replaced by the ones of the new version
+    # - removed: the files that are only in the old version
+    # We use sets, so that each lookup takes a constant time even with huge packages
+    old_files = set(old_tree)
+    new_files = set(new_tree)
+
+    added = [file for file in new_tree if file not in old_files]
+    replaced = [file for file in new_tree if file in old_files]
+    removed = [file for file in old_tree if file not in new_files]
+
+    return added, replaced, removed
+
+def split_version(version: str):
+    # Split a version into its numeric and alphabetic parts: 1.10rc2 gives [1, 10, "rc", 2]
+    return [int(part) if part.isdigit() else part for part in re.findall(r"[0-9]+|[a-zA-Z]+", version)]
+
+def compare_versions(a: str, b: str):
+    # Compare two versions part by part
+    # Returns a negative number if a is older than b, 0 if they are the same version, a positive number if a is newer
+    # The numeric parts are compared as numbers (1.10 is newer than 1.9), and a numeric part is newer
+    # than an alphabetic one (1.0 is newer than 1.0rc1, like 1.0.1 is newer than 1.0)
+    a_parts = split_version(a)
+    b_parts = split_version(b)
+    for a_part, b_part in zip(a_parts, b_parts):
+        if a_part == b_part:
+            continue
+        if isinstance(a_part, int) != isinstance(b_part, int):
+            return 1 if isinstance(a_part, int) else -1
+        return 1 if a_part > b_part else -1
+
+    # One of the versions has more parts than the other one
+    if len(a_parts) == len(b_parts):
+        return 0
+    longer, sign = (a_parts, 1) if len(a_parts) > len(b_parts) else (b_parts, -1)
+    # 1.0rc1 is older than 1.0, but 1.0.1 is newer
+    return sign if isinstance(longer[min(len(a_parts), len(b_parts))], int) else -sign
+
+def plan_upgrade():
+    # Find the installed packages that have a newer version in the repositories
+    # The local DB, the metadata store and the catalog are all read once, and joined on the package name
+    # Returns a list of tuples (package, version, repo_version, local_pkgrel, remote_pkgrel), in the order of the DB
+    remote = {pkg[0]: pkg for pkg in catalog.get_packages()}
+    infos = pkgindex.get_all_info()
+
+    upgrades = []
+    for package, version, date in db.read_local():
+        # If the package isn't in any repository, there is nothing to upgrade
+        if package not in remote:
+            continue
+        repo_version = remote[package][2]
+        remote_pkgrel = remote[package][3]
+
+        order = compare_versions(repo_version, version)
+        if order < 0:
+            continue
+        local_pkgrel = infos.get(package, {}).get("pkgrel")
+        local_pkgrel = int(local_pkgrel) if local_pkgrel is not None else None
+        if order == 0 and (local_pkgrel is None or remote_pkgrel is None or local_pkgrel >= remote_pkgrel):
+            continue
+        upgrades.append((package, version, repo_version, local_pkgrel, remote_pkgrel))
+
+    return upgrades
+
+def upgrade_package(package: str, path: str, stagedir: str = None):
+    # Replace an installed package by the new version in the file path
+    # If the new version has already been staged by addpkg.stagepkg, stagedir is its staging directory
+    # The package stays registered with its old version until the new one is committed,
+    # and the commit removes the old files that the new version doesn't have (see lib/transaction.py)
+    # The counts come from the commit, they are the files it has really added, replaced and removed
+    # The conflicts have been checked for the whole upgrade (see instpkg.check_transaction)
+    changes = instpkg.install_file(path, True, auto_accept=True, check_deps=False, check_conflicts=False, upgrade=True, stagedir=stagedir)
+    if changes is not None:
+        added, replaced, removed = changes
+        log.log_info(str(len(added)) + " files added, " + str(len(replaced)) + " replaced, " + str(len(removed)) + " removed.")
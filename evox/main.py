@@ -1,14 +1,17 @@
 """Evox 1.1.1
 
 Usage:
-  evox get [-y] <package>...
-  evox remove <package>...
-  evox upgrade
-  evox info <package>
-  evox search <expr>
-  evox sync
+  evox get [-y] [--jobs=<n>] [--profile=<format>] <package>...
+  evox remove [--profile=<format>] <package>...
+  evox upgrade [--jobs=<n>] [--dry-run] [--profile=<format>]
+  evox info [--startup-profile] <package>
+  evox search [--regex | --fuzzy] [--profile=<format>] [--startup-profile] <expr>
+  evox sync [--profile=<format>]
   evox init
-  evox tree <package>
+  evox tree [--reverse] [--depth=<n>] [--format=<format>] [--startup-profile] <package>
+  evox owns [--startup-profile] <path>
+  evox cache (clean | stats)
+  evox rdeps [--startup-profile] <package>
   evox (-h | --help)
   evox (-v | --version)
 
@@ -21,55 +24,121 @@ Options:
   upgrade       Upgrade the system
   init          Initialize the default structure following the configuration
   tree          Show the dependencies of an installed package, and the dependencies of their dependencies
+  owns          Show the packages owning a file
+  rdeps         Show the installed packages depending on a package
+  cache         Clean the cache of the downloaded packages, or show its statistics
+  --jobs=<n>    Number of packages unpacked at the same time [default: 1]
+  --regex       Search with a regular expression
+  --fuzzy       Search the packages whose name has the characters of the expression, in the same order
+  --dry-run     Only show the packages that would be upgraded
+  --reverse     Show the packages depending on the package instead of its dependencies
+  --depth=<n>   Maximum depth of the tree
+  --format=<format>  Format of the tree: text, json or dot [default: text]
+  --profile=<format>  Show the time spent in each phase and for each package, and what has been done: text or json
+                      (with EVOX_CPROFILE=<file>, the run is also profiled with cProfile to this file)
+  --startup-profile  Show the time spent starting evox, importing its modules and running the command
   -h --help     Show this screen.
   -v --version     Show version.
 
 """
 
-import shutil
-from docopt import docopt
+# We note when main.py starts, for --startup-profile
+import time
+startup = time.perf_counter()
+startup_cpu = time.process_time()
 
 import os
+import atexit
+from docopt import docopt
 
-import lib.instpkg as instpkg
+# Each command only imports the modules it needs (see below), so that the commands
+# run very often by scripts, like info and search, don't load the installation code
 import lib.log as log
-import lib.config as config
-import lib.rmpkg as rmpkg
-import lib.db as db
-import lib.net as net
 
 from lib.root import *
 
-def find_dependencies(package):
-    tree = {}
-    tree[package] = {}
-    # We get the dependencies of the package
-    dependencies = db.get_local_package_pkgdeps(package)
-    # We loop through the dependencies
-    for dependency in dependencies:
-        # We get the dependencies of the dependency
-        tree[package][dependency] = find_dependencies(dependency)[dependency]
-    return tree
-
-def print_dependencies(tree, level=1, already_printed=[]):
-    # We loop through the dependencies
-    for dependency in tree:
-        if not dependency in already_printed:
-            # We print the dependency
-            print("--" * level + ">" + dependency)
-            # We print the dependencies of the dependency
-            print_dependencies(tree[dependency], level + 1, already_printed)
-
-            already_printed.append(dependency)
-
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='Evox 1.1.1')
 
+    # The startup profile is printed when the command ends
+    if arguments['--startup-profile']:
+        import lib.profile as profile
+        atexit.register(profile.report_startup, startup, startup_cpu, time.perf_counter())
+
+    # The profile is printed when the command ends, after the local DB has been written
+    if arguments['--profile'] is not None:
+        import lib.profile as profile
+        if arguments['--profile'] not in ("text", "json"):
+            log.log_error("Unknown profile format: " + arguments['--profile'])
+            exit(1)
+        profile.enable()
+        atexit.register(profile.report, arguments['--profile'])
+
+    # We check the options before doing anything
+    if not arguments['--jobs'].isdigit() or int(arguments['--jobs']) < 1:
+        log.log_error("The number of jobs must be a positive number: " + arguments['--jobs'])
+        exit(1)
+    if arguments['--depth'] is not None and not arguments['--depth'].isdigit():
+        log.log_error("The depth must be a number: " + arguments['--depth'])
+        exit(1)
+    if arguments['--format'] not in ("text", "json", "dot"):
+        log.log_error("Unknown tree format: " + arguments['--format'])
+        exit(1)
+
+    # The dry run of upgrade only reads the DB: it doesn't take the lock, nor finish an interrupted
+    # transaction (which may be the one another evox is running)
+    if arguments['upgrade'] and arguments['--dry-run']:
+        import lib.profile as profile
+        import lib.upgrade as upgrade
+
+        with profile.span("plan upgrade"):
+            upgrades = upgrade.plan_upgrade()
+        if len(upgrades) == 0:
+            log.log_info("Nothing to upgrade.")
+        for package, version, repo_version, local_pkgrel, remote_pkgrel in upgrades:
+            log.log_info(package + " " + version + "-" + str(local_pkgrel) + " -> " + repo_version + "-" + str(remote_pkgrel))
+        exit(0)
+
+    # The changes made to the local DB by get, remove and upgrade are written all at once,
+    # when the command ends (even if it stops on an error), and then the triggers and the
+    # post-install scripts of the installed packages are run (the exit functions run in reverse order)
+    if arguments['get'] or arguments['remove'] or arguments['upgrade']:
+        import lib.db as db
+        import lib.instpkg as instpkg
+        import lib.profile as profile
+        import lib.transaction as transaction
+        import lib.triggers as triggers
+
+        atexit.register(triggers.run)
+        db.begin()
+        atexit.register(db.commit)
+        # If evox has been killed during an installation, we finish it or undo it first
+        transaction.recover()
+
     if arguments['get']:
+        import lib.resolver as resolver
+
+        # The packages given by name that aren't installed yet are installed in a single transaction,
+        # computed before anything is downloaded or installed
+        names = [package for package in arguments['<package>'] if not os.path.exists(package) and not instpkg.is_url(package) and not instpkg.is_package_installed(package)]
+        if len(names) > 0:
+            with profile.span("resolve"):
+                plan = resolver.resolve(names)
+            instpkg.install_transaction(plan, names, auto_accept=arguments['-y'], jobs=int(arguments['--jobs']))
+            for package in names:
+                if instpkg.is_package_installed(package):
+                    log.log_success("Package " + package + " installed successfully!")
+
+        # The files, the URLs and the installed packages are handled one by one
         for package in arguments['<package>']:
-            instpkg.install_pkg(package, auto_accept=arguments['-y'])
+            if package not in names:
+                instpkg.install_pkg(package, auto_accept=arguments['-y'])
 
     if arguments['init']:
+        import shutil
+        import lib.config as config
+        import lib.db as db
+
         # We just need to create the /var/evox/packages directory, the /var/evox/repos directory
         # We can use the os.makedirs function
         os.makedirs(root + "/var/evox/packages", exist_ok=True)
@@ -87,19 +156,21 @@ if __name__ == '__main__':
             os.makedirs(root + "/var/evox/repos/" + repo, exist_ok=True)
 
         # We also need to create the /var/evox/packages/DB file
-        # We can use the open function
-        open(root + "/var/evox/packages/DB", "w").close()
+        db.init_local()
 
         # We can log a success message
         log.log_success("The default structure has been created.")
 
     if arguments['remove']:
+        import lib.rmpkg as rmpkg
+
         for package in arguments['<package>']:
             # First, we check if the package is installed
             # We can use the lib.instpkg.is_installed function
             if instpkg.is_package_installed(package):
                 # If it is, we remove it
-                rmpkg.rmpkg(package)
+                with profile.span("remove", package):
+                    rmpkg.rmpkg(package)
                 if not instpkg.is_package_installed(package):
                     # If it is removed, we log a success message
                     log.log_success("The package " + package +
@@ -109,128 +180,116 @@ if __name__ == '__main__':
                 log.log_error("The package " + package + " is not installed.")
 
     if arguments['sync']:
+        import lib.catalog as catalog
+        import lib.config as config
+        import lib.db as db
+        import lib.pkgindex as pkgindex
+        import lib.profile as profile
+        import lib.sync as sync
+
         # We get the config
         repos = config.get_config()
 
-        # We loop through the repositories
+        # We sync all the repositories at the same time, only downloading what has changed
+        with profile.span("sync"):
+            changed = sync.sync_repos(repos)
+
         for repo in repos:
-            # We get the URL of the repository
-            url = repos[repo]["url"]
-            # The path of the repository is /var/evox/repos/repo
-            path = root + "/var/evox/repos/" + repo
+            # We can log a success message
+            if changed[repo]:
+                log.log_success("The repository " + repo + " has been synced.")
+            else:
+                log.log_success("The repository " + repo + " is up to date.")
 
-            # If the repository doesn't exist, we create it
-            # We can use the os.path.exists function
-            if not os.path.exists(path):
-                # We can use the os.makedirs function
-                os.makedirs(path, exist_ok=True)
+        # We compile all the INDEX files into the catalog, if one of them or the list of repositories has changed
+        if any(changed.values()) or not catalog.is_current() or catalog.get_repos() != set(repos):
+            with profile.span("catalog"):
+                catalog.build(list(repos))
 
-            # We simply get the INDEX file from the repository with net.download
-            index = net.download(url + "/INDEX", path + "/INDEX", False)
-
-            # We can log a success message
-            log.log_success("The repository " + repo + " has been synced.")
+        # We also build the index of the installed packages if it doesn't exist yet or has an older format,
+        # while we hold the lock of the DB, so that the commands reading it don't have to build it in memory
+        if os.path.isfile(db.DB) and not pkgindex.is_current():
+            db.begin()
+            pkgindex.open_index()
+            db.commit()
 
     if arguments['upgrade']:
-        # We get the installed packages
-        installed_packages = db.get_installed_packages()
-
-        # We loop through the packages
-        for package in installed_packages:
-            # We check if the package is in the repository thanks to the os.path.exists function
-            if os.path.exists(root + "/var/evox/packages/" + package):
-                # If it is, we get the version of the package
-                version = installed_packages[package]
-                # We get the version of the package in the repository
-                repo_version = db.get_remote_package_version(package)
-                local_pkgrel = db.get_local_package_pkgrel(package)
-                remote_pkgrel = db.get_remote_package_pkgrel(package)
-                # If the version of the package in the repository is higher than the installed version
-                if repo_version != version or local_pkgrel < remote_pkgrel:
-                    # Log an info message
-                    log.log_info("The package " + package + " is being upgraded from version " + version + "-" + str(
-                        local_pkgrel) + " to version " + repo_version + "-" + str(remote_pkgrel) + ".")
-                    # First, we need to move the old package to /var/evox/packages/<package>.old
-                    # We can use the os.rename function
-                    shutil.move(root + "/var/evox/packages/" + package,
-                              root + "/var/evox/packages/" + package + ".old")
-
-                    # We unregister the package
-                    db.unregister_local(package)
-
-                    # Then, we need to install the new package
-                    instpkg.install_pkg(package, auto_accept=True, upgrade=True)
-
-                    # After that, we need to remove the old package 
-                    # But be careful, we need to only remove the old files and not the new ones
-                    # So to do that, we need to get the files of the old package and the new package
-                    # We read the PKGTREE file of the old package
-                    old_pkgtree = open(root + "/var/evox/packages/" + package + ".old/PKGTREE", "r").readlines()
-                    # We read the PKGTREE file of the new package
-                    new_pkgtree = open(root + "/var/evox/packages/" + package + "/PKGTREE", "r").readlines()
-
-                    # We create a list of the old files
-                    old_files = []
-                    # We loop through the old PKGTREE
-                    for line in old_pkgtree:
-                        # We add the file to the list
-                        old_files.append(line.strip())
-
-                    # We create a list of the new files
-                    new_files = []
-                    # We loop through the new PKGTREE
-                    for line in new_pkgtree:
-                        # We add the file to the list
-                        new_files.append(line.strip())
-
-                    files_to_remove = []
-                    # We loop through the old files
-                    for file in old_files:
-                        # We check if the file is not in the new files
-                        if file not in new_files:
-                            # If it isn't, we add it to the list of files to remove
-                            files_to_remove.append(file)
-
-                    # We give the list of files to remove to the rmpkg.rmtree function
-                    rmpkg.rmtree(files_to_remove)
-
-                    # Finally, we remove the old package
-                    shutil.rmtree(root + "/var/evox/packages/" + package + ".old")
-
-                    # We log a success message
-                    log.log_success("The package " + package + " has been upgraded from version " + version + "-" + str(
-                        local_pkgrel) + " to version " + repo_version + "-" + str(remote_pkgrel) + ".")
+        import lib.resolver as resolver
+        import lib.scheduler as scheduler
+        import lib.upgrade as upgrade
+
+        # We find the packages to upgrade, before downloading anything
+        with profile.span("plan upgrade"):
+            upgrades = upgrade.plan_upgrade()
+
+        # We compute the whole transaction: the packages to upgrade and their new dependencies
+        with profile.span("resolve"):
+            plan = resolver.resolve([entry[0] for entry in upgrades], upgrade=True)
+        upgrades = {entry[0]: entry for entry in upgrades}
+
+        # We download all the packages at the same time, and check them all before installing the first one
+        fetched = resolver.fetch(plan)
+        instpkg.check_transaction(plan)
+
+        # We loop through the transaction, each package comes after its dependencies
+        # The next packages are unpacked in the background when several jobs are allowed
+        for (action, package, new_version, new_pkgrel, repo), stagedir in scheduler.schedule(plan, int(arguments['--jobs'])):
+            path = resolver.get_package_path(repo, package, new_version)
+
+            if action == "install":
+                # It's a new dependency
+                log.log_info("Installing dependency " + package + "...")
+                instpkg.install_file(path, True, auto_accept=True, check_deps=False, check_conflicts=False, stagedir=stagedir)
+                log.log_success("Dependency " + package + " installed successfully!")
+                os.remove(path)
+                continue
+
+            package, version, repo_version, local_pkgrel, remote_pkgrel = upgrades[package]
+
+            # Log an info message
+            log.log_info("The package " + package + " is being upgraded from version " + version + "-" + str(
+                local_pkgrel) + " to version " + repo_version + "-" + str(remote_pkgrel) + ".")
+            # We replace the old version by the new one
+            upgrade.upgrade_package(package, path, stagedir)
+            os.remove(path)
+
+            # We log a success message
+            log.log_success("The package " + package + " has been upgraded from version " + version + "-" + str(
+                local_pkgrel) + " to version " + repo_version + "-" + str(remote_pkgrel) + ".")
+
+        # We remove the downloaded packages that haven't been installed
+        for path in fetched:
+            if os.path.exists(path):
+                os.remove(path)
 
     if arguments['search']:
-        # We get the config
-        repos = config.get_config()
+        import lib.profile as profile
+        import lib.search as search
+
         # We get the expression
         expr = arguments['<expr>']
-        # We create a list of packages
-        packages = db.get_remote_packages()
-        installed_packages = db.get_installed_packages()
-        # We loop through the packages
-        for package in packages:
-            # If the package contains the expression
-            if expr in package[0]:
-                if instpkg.is_package_installed(package[0]):
-                    local_pkgrel = db.get_local_package_pkgrel(package[0])
-                    # We log the package
-                    log.log_info(package[0] + " (" + package[1] + "-" + package[2] + ")[Installed " +
-                                 installed_packages[package[0]] + "-" + str(local_pkgrel) + "]")
-                else:
-                    # We log the package
-                    log.log_info(
-                        package[0] + " (" + package[1] + "-" + package[2] + ")")
+        mode = "regex" if arguments['--regex'] else "fuzzy" if arguments['--fuzzy'] else "substring"
+        # We loop through the packages found, the best matches first
+        with profile.span("search"):
+            packages = search.search(expr, mode)
+        for name, version, pkgrel, description, local_version, local_pkgrel in packages:
+            line = name + " (" + version + "-" + str(pkgrel) + ")"
+            if local_version is not None:
+                line += "[Installed " + local_version + "-" + str(local_pkgrel) + "]"
+            if description is not None:
+                line += " " + description
+            # We log the package
+            log.log_info(line)
 
     if arguments['info']:
-        # We get the config
-        repos = config.get_config()
+        from colorama import Style
+        import lib.db as db
+
         # We get the package
         package = arguments['<package>'][0]
         # We get the package info
         info = db.get_local_package_info(package)
-	# Assignate info to variables
+        # Assignate info to variables
         name = info['name']
         version = info['version']
         description = info['description']
@@ -250,14 +309,59 @@ if __name__ == '__main__':
         source_spacer = ' ' * (len(source) + 4 - len('source'))
         # We log the info
         print(f'\n{Style.BRIGHT}Name{name_spacer}Version{version_spacer}Description{description_spacer}License{license_spacer}Maintainer{maintainer_spacer}Source{source_spacer}{url}')
-	print(f'{name}    {version}    {description}    {license}    {maintainer}    {source}    {url}')
+        print(f'{name}    {version}    {description}    {license}    {maintainer}    {source}    {url}')
 
 
     if arguments['tree']:
+        import lib.db as db
+        import lib.tree as tree
+
         package = arguments['<package>'][0]
-        if not instpkg.is_package_installed(package):
+        if not db.is_installed(package):
             log.log_error(f"The package {package} is not installed.")
             exit(1)
-        tree = find_dependencies(package)
-        print(package)
-        print_dependencies(tree[package])
+        # We build the graph of the installed packages once, and only keep the part we need
+        depth = int(arguments['--depth']) if arguments['--depth'] is not None else None
+        graph = tree.subgraph(tree.build_graph(arguments['--reverse']), package, depth)
+        if arguments['--format'] == "json":
+            print(tree.format_json(graph, package, arguments['--reverse']))
+        elif arguments['--format'] == "dot":
+            print(tree.format_dot(graph, package, arguments['--reverse']))
+        elif arguments['--format'] == "text":
+            for line in tree.format_text(graph, package):
+                print(line)
+
+    if arguments['owns']:
+        import lib.pkgindex as pkgindex
+
+        path = arguments['<path>']
+        # We look the path up in the file ownership index
+        owners = pkgindex.get_owners(path)
+        if len(owners) == 0:
+            log.log_error("No package owns " + path + ".")
+            exit(1)
+        for owner in owners:
+            log.log_info(path + " is owned by " + owner)
+
+    if arguments['rdeps']:
+        import lib.pkgindex as pkgindex
+
+        package = arguments['<package>'][0]
+        # We look the package up in the reverse dependency index
+        rdeps = pkgindex.get_rdeps(package)
+        if len(rdeps) == 0:
+            log.log_info("No installed package depends on " + package + ".")
+        for rdep in rdeps:
+            log.log_info(rdep)
+
+    if arguments['cache']:
+        import lib.cache as cache
+
+        if arguments['clean']:
+            cache.clean()
+            log.log_success("The cache has been cleaned.")
+        if arguments['stats']:
+            packages, refs, size = cache.stats()
+            log.log_info("Cache directory: " + cache.get_cache_dir())
+            log.log_info("Packages: " + str(packages) + " (" + str(refs) + " versions)")
+            log.log_info("Size: " + str(round(size / 1024 / 1024, 1)) + " MiB / " + (str(cache.get_cache_size() // 1024 // 1024) + " MiB" if cache.get_cache_size() > 0 else "no limit"))